@@ -1,13 +1,30 @@
 """
 Flask API server for Budget AI - handles all backend operations including database, AI integration, and financial calculations.
 """
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g, has_request_context
 from flask_cors import CORS
+import click
 import sqlite3
 import os
+import re
+import threading
+import time
+import queue
+import heapq
+import itertools
+from collections import deque, Counter
 from datetime import datetime, timedelta
 import json
+import csv
+import hashlib
+import tempfile
+import gzip
+import math
+import zlib
+from functools import lru_cache
+from urllib.request import pathname2url
 from typing import Dict
+import numpy as np
 from dotenv import load_dotenv
 
 env_path = os.path.join(os.path.dirname(__file__), '.env')
@@ -20,11 +37,54 @@ try:
 except ImportError:
     OPENAI_AVAILABLE = False
 
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
 app = Flask(__name__)
 CORS(app)
 
 DATABASE = 'budget.db'
 
+VERSIONED_TABLES = ('income', 'categories', 'expenses', 'savings_goals', 'investments', 'debts', 'recurring_expenses')
+
+SEARCH_SOURCES = [
+    ('expenses', 'expense', 0, 'description', 'category_id', 'date_added'),
+    ('recurring_expenses', 'recurring', 1, 'name', 'category_id', 'next_due_date'),
+    ('income', 'income', 2, 'source', None, 'date_added'),
+]
+
+SEARCH_INDEX_COLUMNS = ("content, kind UNINDEXED, ref_id UNINDEXED, category_id UNINDEXED, day UNINDEXED, "
+                        "prefix='2 3', tokenize='unicode61 remove_diacritics 2'")
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archives')
+EXPENSE_FIELDS = 'id, amount, category_id, description, date_added'
+EXPENSE_COLUMNS = f'{EXPENSE_FIELDS}, fingerprint, labelled'
+
+def search_index_values(row: str, kind: str, code: int, text_column: str, category_column, day_column: str) -> str:
+    category = f'{row}.{category_column}' if category_column else 'NULL'
+    return f"{row}.id * 4 + {code}, {row}.{text_column}, '{kind}', {row}.id, {category}, date({row}.{day_column})"
+
 def init_db():
     conn = sqlite3.connect(DATABASE)
     c = conn.cursor()
@@ -89,6 +149,147 @@ def init_db():
                   is_active INTEGER DEFAULT 1,
                   FOREIGN KEY (category_id) REFERENCES categories(id))''')
     
+    c.execute('''CREATE TABLE IF NOT EXISTS category_stats
+                 (category_id INTEGER PRIMARY KEY,
+                  count INTEGER NOT NULL DEFAULT 0,
+                  mean REAL NOT NULL DEFAULT 0,
+                  m2 REAL NOT NULL DEFAULT 0,
+                  sketch TEXT,
+                  FOREIGN KEY (category_id) REFERENCES categories(id))''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS expense_anomalies
+                 (expense_id INTEGER PRIMARY KEY,
+                  category_id INTEGER,
+                  amount REAL NOT NULL,
+                  mean REAL,
+                  z_score REAL,
+                  date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (expense_id) REFERENCES expenses(id))''')
+    
+    c.execute('PRAGMA table_info(expenses)')
+    expense_columns = [row[1] for row in c.fetchall()]
+    if 'fingerprint' not in expense_columns:
+        c.execute('ALTER TABLE expenses ADD COLUMN fingerprint INTEGER')
+    if 'labelled' not in expense_columns:
+        # Imports only learned rows whose category came from the file, which wasn't recorded; count none of them.
+        c.execute('ALTER TABLE expenses ADD COLUMN labelled INTEGER NOT NULL DEFAULT 1')
+        c.execute('UPDATE expenses SET labelled = 0 WHERE fingerprint IS NOT NULL')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_fingerprint ON expenses(fingerprint)')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS category_model_features
+                 (category_id INTEGER NOT NULL,
+                  feature INTEGER NOT NULL,
+                  count INTEGER NOT NULL,
+                  PRIMARY KEY (category_id, feature)) WITHOUT ROWID''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS category_model_totals
+                 (category_id INTEGER PRIMARY KEY,
+                  documents INTEGER NOT NULL,
+                  features INTEGER NOT NULL)''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS category_model_meta
+                 (name TEXT PRIMARY KEY,
+                  value REAL NOT NULL)''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS expense_archives
+                 (year INTEGER PRIMARY KEY,
+                  path TEXT NOT NULL,
+                  expense_count INTEGER NOT NULL DEFAULT 0,
+                  total REAL NOT NULL DEFAULT 0,
+                  archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS import_jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  filename TEXT,
+                  format TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'queued',
+                  total_bytes INTEGER DEFAULT 0,
+                  bytes_read INTEGER DEFAULT 0,
+                  rows_read INTEGER DEFAULT 0,
+                  inserted INTEGER DEFAULT 0,
+                  duplicates INTEGER DEFAULT 0,
+                  skipped INTEGER DEFAULT 0,
+                  error TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  finished_at TIMESTAMP)''')
+    
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'investment_values'")
+    investment_values_exist = c.fetchone() is not None
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS investment_values
+                 (investment_id INTEGER NOT NULL,
+                  day INTEGER NOT NULL,
+                  value REAL NOT NULL,
+                  PRIMARY KEY (investment_id, day)) WITHOUT ROWID''')
+    
+    if not investment_values_exist:
+        c.execute('''INSERT OR IGNORE INTO investment_values (investment_id, day, value)
+                     SELECT id, CAST(julianday(purchase_date) - 2440587.5 AS INTEGER), amount
+                     FROM investments WHERE purchase_date IS NOT NULL AND julianday(purchase_date) IS NOT NULL''')
+        c.execute('''INSERT OR REPLACE INTO investment_values (investment_id, day, value)
+                     SELECT id, CAST(julianday('now', 'localtime') - 2440587.5 AS INTEGER), COALESCE(current_value, amount)
+                     FROM investments''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS net_worth_daily
+                 (day INTEGER PRIMARY KEY,
+                  income REAL NOT NULL DEFAULT 0,
+                  expenses REAL NOT NULL DEFAULT 0,
+                  investments REAL NOT NULL DEFAULT 0,
+                  savings REAL NOT NULL DEFAULT 0,
+                  debts REAL NOT NULL DEFAULT 0,
+                  net_worth REAL NOT NULL DEFAULT 0)''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS ai_recommendations
+                 (version INTEGER PRIMARY KEY,
+                  data_versions TEXT NOT NULL,
+                  fingerprint TEXT NOT NULL,
+                  recommendations TEXT NOT NULL,
+                  source TEXT NOT NULL,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS data_versions
+                 (name TEXT PRIMARY KEY,
+                  version INTEGER NOT NULL DEFAULT 0)''')
+    
+    for table in VERSIONED_TABLES:
+        c.execute('INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)', (table,))
+        for action in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_version_{action.lower()} AFTER {action} ON {table}
+                          BEGIN
+                              UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+                          END''')
+    
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'")
+    search_index_exists = c.fetchone() is not None
+    
+    c.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5 ({SEARCH_INDEX_COLUMNS})')
+    
+    for table, kind, code, text_column, category_column, day_column in SEARCH_SOURCES:
+        new_values = search_index_values('new', kind, code, text_column, category_column, day_column)
+        watched = ', '.join(col for col in (text_column, category_column, day_column) if col)
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table}
+                      WHEN COALESCE(new.{text_column}, '') <> ''
+                      BEGIN
+                          INSERT INTO search_index (rowid, content, kind, ref_id, category_id, day)
+                          VALUES ({new_values});
+                      END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table}
+                      BEGIN
+                          DELETE FROM search_index WHERE rowid = old.id * 4 + {code};
+                      END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF {watched} ON {table}
+                      BEGIN
+                          DELETE FROM search_index WHERE rowid = old.id * 4 + {code};
+                          INSERT INTO search_index (rowid, content, kind, ref_id, category_id, day)
+                          SELECT {new_values} WHERE COALESCE(new.{text_column}, '') <> '';
+                      END''')
+        if not search_index_exists:
+            c.execute(f'''INSERT INTO search_index (rowid, content, kind, ref_id, category_id, day)
+                          SELECT {search_index_values(table, kind, code, text_column, category_column, day_column)}
+                          FROM {table}
+                          WHERE COALESCE({text_column}, '') <> ''
+                      ''')
+    
     default_categories = [
         ('Food', 200, '#EF4444'),
         ('Transport', 100, '#3B82F6'),
@@ -106,6 +307,1023 @@ def init_db():
 
 init_db()
 
+def attach_limit(conn) -> int:
+    """How many databases one connection may attach; SQLite's default build allows 10."""
+    return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(conn, 'getlimit') else 10
+
+def attach_archives(conn, start: str = None, end: str = None):
+    """Attach the read-only yearly expense archives overlapping [start, end] and return their schema names.
+    A bound that doesn't start with a year leaves that side of the range open."""
+    c = conn.cursor()
+    c.execute('SELECT year, path FROM main.expense_archives WHERE year BETWEEN ? AND ? ORDER BY year',
+              (int(start[:4]) if start and start[:4].isdigit() else 0,
+               int(end[:4]) if end and end[:4].isdigit() else 9999))
+    archives = c.fetchall()
+    if not archives:
+        return []
+    limit = attach_limit(conn)
+    if len(archives) > limit:
+        raise sqlite3.OperationalError(f"{len(archives)} expense archives exceed SQLite's limit of {limit} "
+                                       "attached databases")
+    
+    attached = {row[1] for row in c.execute('PRAGMA database_list')}
+    schemas = []
+    for year, path in archives:
+        schema = f'archive_{year}'
+        if schema not in attached:
+            c.execute(f'ATTACH DATABASE ? AS {schema}',
+                      (f"file:{pathname2url(os.path.abspath(path))}?mode=ro",))
+        schemas.append(schema)
+    return schemas
+
+def expense_source(conn, start: str = None, end: str = None) -> str:
+    """Relation holding every expense between start and end: the live table alone, or a view over it and its archives."""
+    schemas = attach_archives(conn, start, end)
+    if not schemas:
+        return 'expenses'
+    
+    c = conn.cursor()
+    selects = [f'SELECT {EXPENSE_COLUMNS} FROM main.expenses']
+    for schema in schemas:
+        columns = EXPENSE_COLUMNS
+        if 'labelled' not in {row[1] for row in c.execute(f'PRAGMA {schema}.table_info(expenses)')}:
+            columns = f'{EXPENSE_FIELDS}, fingerprint, fingerprint IS NULL AS labelled'
+        selects.append(f'SELECT {columns} FROM {schema}.expenses')
+    c.execute('DROP VIEW IF EXISTS temp.expense_history')
+    c.execute(f"CREATE TEMP VIEW expense_history AS {' UNION ALL '.join(selects)}")
+    return 'expense_history'
+
+def get_data_versions(c, *tables):
+    c.execute(f"SELECT name, version FROM data_versions WHERE name IN ({', '.join('?' for _ in tables)})", tables)
+    versions = dict(c.fetchall())
+    return tuple(versions.get(table, 0) for table in tables)
+
+WRITE_MODE = os.getenv('WRITE_MODE', 'direct')
+GROUP_COMMIT_WINDOW_MS = float(os.getenv('GROUP_COMMIT_WINDOW_MS', 2))
+GROUP_COMMIT_MAX = int(os.getenv('GROUP_COMMIT_MAX', 64))
+
+class GroupCommitWriter:
+    """Single writer thread that applies queued mutations, each in its own savepoint, and commits them in groups.
+    A group closes GROUP_COMMIT_WINDOW_MS after its first mutation or at GROUP_COMMIT_MAX mutations."""
+    
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def submit(self, fn, *args):
+        """Run fn(c, *args) on the writer's cursor and return its result (or raise its error) once its group commits."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='group-commit', daemon=True)
+                self.thread.start()
+        item = {'fn': fn, 'args': args, 'done': threading.Event(), 'result': None, 'error': None}
+        self.queue.put(item)
+        item['done'].wait()
+        if item['error'] is not None:
+            raise item['error']
+        return item['result']
+    
+    def collect(self):
+        group = [self.queue.get()]
+        deadline = time.monotonic() + GROUP_COMMIT_WINDOW_MS / 1000
+        while len(group) < GROUP_COMMIT_MAX:
+            remaining = deadline - time.monotonic()
+            try:
+                group.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return group
+    
+    def run(self):
+        conn = sqlite3.connect(DATABASE)
+        c = conn.cursor()
+        while True:
+            group = self.collect()
+            try:
+                c.execute('BEGIN IMMEDIATE')
+                for item in group:
+                    c.execute('SAVEPOINT mutation')
+                    try:
+                        item['result'] = item['fn'](c, *item['args'])
+                        c.execute('RELEASE mutation')
+                    except Exception as e:
+                        c.execute('ROLLBACK TO mutation')
+                        c.execute('RELEASE mutation')
+                        item['error'] = e
+                conn.commit()
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                for item in group:
+                    item['error'] = item['error'] or e
+            for item in group:
+                item['done'].set()
+
+group_writer = GroupCommitWriter()
+
+def write(fn, *args):
+    """Run fn(c, *args) and commit it: on a fresh connection, or in the writer's next group with WRITE_MODE=group."""
+    if WRITE_MODE == 'group':
+        return group_writer.submit(fn, *args)
+    conn = sqlite3.connect(DATABASE)
+    try:
+        result = fn(conn.cursor(), *args)
+        conn.commit()
+        return result
+    finally:
+        conn.close()
+
+READ_MODE = os.getenv('READ_MODE', 'primary')
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'budget-snapshot.db')
+SNAPSHOT_MAX_AGE = float(os.getenv('SNAPSHOT_MAX_AGE', 60))
+SNAPSHOT_REFRESH_SECONDS = float(os.getenv('SNAPSHOT_REFRESH_SECONDS', SNAPSHOT_MAX_AGE / 2))
+SNAPSHOT_BACKUP_PAGES = 256
+
+class SnapshotReplica:
+    """Read-only copy of the database for long analytic reads, taken with SQLite's online backup API.
+    Reads never wait for a copy: one more than SNAPSHOT_MAX_AGE seconds behind wakes the refresh thread early."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.copy_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.versions = None
+        self.as_of = None
+    
+    def age(self):
+        """Seconds since the snapshot was last known to match the primary, or since a previous run wrote it."""
+        if self.as_of is None:
+            return time.time() - os.path.getmtime(SNAPSHOT_PATH) if os.path.exists(SNAPSHOT_PATH) else None
+        return time.monotonic() - self.as_of
+    
+    def refresh(self, force: bool = False) -> Dict:
+        """Copy the primary into the snapshot, unless no table has changed since the last copy."""
+        with self.copy_lock:
+            checked = time.monotonic()
+            conn = sqlite3.connect(DATABASE)
+            versions = get_data_versions(conn.cursor(), *VERSIONED_TABLES)
+            copied = force or versions != self.versions or not os.path.exists(SNAPSHOT_PATH)
+            if copied:
+                # Back up into a new file and swap it in, so readers of the old copy never see a locked database.
+                fd, path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(SNAPSHOT_PATH)))
+                os.close(fd)
+                target = sqlite3.connect(path)
+                try:
+                    conn.backup(target, pages=SNAPSHOT_BACKUP_PAGES, sleep=0.05)
+                    target.close()
+                    os.replace(path, SNAPSHOT_PATH)
+                except BaseException:
+                    target.close()
+                    os.remove(path)
+                    raise
+            conn.close()
+            self.versions = versions
+            self.as_of = checked
+        return {'copied': copied, 'seconds': round(time.monotonic() - checked, 3),
+                'bytes': os.path.getsize(SNAPSHOT_PATH)}
+    
+    def run(self):
+        while True:
+            self.wake.wait(SNAPSHOT_REFRESH_SECONDS)
+            self.wake.clear()
+            try:
+                self.refresh()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Snapshot refresh failed: {e}")
+    
+    def connect(self):
+        """Read-only connection to the current snapshot, and its age in seconds."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='snapshot', daemon=True)
+                self.thread.start()
+        age = self.age()
+        if age is None:
+            self.refresh()
+        elif age > SNAPSHOT_MAX_AGE:
+            self.wake.set()
+        conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(SNAPSHOT_PATH))}?mode=ro", uri=True)
+        return conn, self.age()
+
+snapshot_replica = SnapshotReplica()
+
+def analytics_connect():
+    """Connection for export and analytic routes: the snapshot with READ_MODE=snapshot, otherwise the primary."""
+    if READ_MODE != 'snapshot':
+        return sqlite3.connect(DATABASE)
+    conn, g.snapshot_age = snapshot_replica.connect()
+    return conn
+
+@app.after_request
+def add_snapshot_age(response):
+    if g.get('snapshot_age') is not None:
+        response.headers['X-Snapshot-Age'] = f"{g.snapshot_age:.1f}"
+    return response
+
+def add_months(start: datetime, months: int) -> str:
+    year, month = divmod(start.month - 1 + months, 12)
+    return f"{start.year + year:04d}-{month + 1:02d}"
+
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+def day_number(value=None) -> int:
+    day = datetime.strptime(value[:10], '%Y-%m-%d') if value else datetime.now()
+    return day.toordinal() - EPOCH_ORDINAL
+
+def day_string(number: int) -> str:
+    return datetime.fromordinal(int(number) + EPOCH_ORDINAL).strftime('%Y-%m-%d')
+
+def downsample_lttb(xs, ys, threshold: int):
+    """Largest-Triangle-Three-Buckets: indices of the points that best preserve the shape of the series."""
+    count = len(xs)
+    if threshold >= count or threshold < 3:
+        return list(range(count))
+    
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    edges = np.linspace(1, count - 1, threshold - 1).astype(int)
+    selected = [0]
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else count
+        avg_x = xs[end:next_end].mean() if next_end > end else xs[-1]
+        avg_y = ys[end:next_end].mean() if next_end > end else ys[-1]
+        
+        prev = selected[-1]
+        area = np.abs((xs[prev] - avg_x) * (ys[start:end] - ys[prev]) -
+                      (xs[prev] - xs[start:end]) * (avg_y - ys[prev]))
+        selected.append(start + int(area.argmax()))
+    selected.append(count - 1)
+    return selected
+
+NET_WORTH_COLUMNS = ('income', 'expenses', 'investments', 'savings', 'debts', 'net_worth')
+
+def sql_day(column: str) -> str:
+    """SQL expression for the day number of a stored timestamp, matching day_number()."""
+    return f'CAST(julianday({column}) - 2440587.5 AS INTEGER)'
+
+def net_worth_today() -> int:
+    """The newest day in net_worth_daily. Timestamps are stored in UTC but investment values are dated locally,
+    so this is whichever of the two dates is later, and every write lands in the row get_overview reads."""
+    return max(day_number(), day_number(datetime.utcnow().strftime('%Y-%m-%d')))
+
+def month_end(day: int) -> int:
+    return day_number(add_months(datetime.fromordinal(day + EPOCH_ORDINAL), 1) + '-01') - 1
+
+def carry_net_worth(row, until: int):
+    """Rows for the days after `row` up to `until` when nothing changed: balances carry over and expenses
+    restart each month."""
+    day, income, expenses, investments, savings, debts, _ = row
+    rows = []
+    for day in range(day + 1, until + 1):
+        if day_string(day).endswith('-01'):
+            expenses = 0.0
+        rows.append((day, income, expenses, investments, savings, debts,
+                     round(income - expenses + investments + savings - debts, 2)))
+    return rows
+
+def ensure_net_worth_days(c, day: int):
+    """Make net_worth_daily cover `day` through today, so a change on `day` has rows to land in, and return its
+    last day."""
+    c.execute('SELECT MIN(day) FROM net_worth_daily')
+    first = c.fetchone()[0]
+    if first is None or day < first:
+        start = min(day, net_worth_today())
+        c.executemany('INSERT INTO net_worth_daily (day) VALUES (?)',
+                      [(d,) for d in range(start, first if first is not None else start + 1)])
+    
+    c.execute('SELECT * FROM net_worth_daily ORDER BY day DESC LIMIT 1')
+    last = c.fetchone()
+    c.executemany('INSERT INTO net_worth_daily VALUES (?, ?, ?, ?, ?, ?, ?)',
+                  carry_net_worth(last, max(day, net_worth_today())))
+    return max(last[0], day, net_worth_today())
+
+def apply_net_worth_delta(c, day: int, until: int = None, income: float = 0, expenses: float = 0,
+                          investments: float = 0, savings: float = 0, debts: float = 0):
+    """Add a change that took effect on `day` to every daily row from then on, or up to `until` if it ends.
+    Expenses only count in their own month, so they touch at most 31 rows."""
+    if not (income or expenses or investments or savings or debts):
+        return
+    last = ensure_net_worth_days(c, day)
+    
+    if expenses:
+        c.execute('''UPDATE net_worth_daily
+                     SET expenses = ROUND(expenses + ?, 2), net_worth = ROUND(net_worth - ?, 2)
+                     WHERE day BETWEEN ? AND ?''',
+                  (expenses, expenses, day, min(month_end(day), until if until is not None else month_end(day))))
+    if income or investments or savings or debts:
+        c.execute('''UPDATE net_worth_daily
+                     SET income = ROUND(income + :income, 2),
+                         investments = ROUND(investments + :investments, 2),
+                         savings = ROUND(savings + :savings, 2),
+                         debts = ROUND(debts + :debts, 2),
+                         net_worth = ROUND(net_worth + :income + :investments + :savings - :debts, 2)
+                     WHERE day BETWEEN :day AND :until''',
+                  {'day': day, 'until': until if until is not None else last, 'income': income, 'investments': investments, 'savings': savings,
+                   'debts': debts})
+
+def record_investment_value(c, investment_id: int, day: int, value: float):
+    """Store an investment's value on `day`; it holds until the next recorded value, and so does its net worth delta."""
+    c.execute('''SELECT value FROM investment_values WHERE investment_id = ? AND day <= ?
+                 ORDER BY day DESC LIMIT 1''', (investment_id, day))
+    row = c.fetchone()
+    c.execute('SELECT MIN(day) FROM investment_values WHERE investment_id = ? AND day > ?', (investment_id, day))
+    following = c.fetchone()[0]
+    
+    c.execute('INSERT OR REPLACE INTO investment_values (investment_id, day, value) VALUES (?, ?, ?)',
+              (investment_id, day, value))
+    apply_net_worth_delta(c, day, following - 1 if following is not None else None,
+                          investments=value - (row[0] if row else 0))
+
+def value_steps(series, sign: int = 1) -> Counter:
+    """{day: change} for a sorted (day, value) step series that starts from zero."""
+    steps = Counter()
+    previous = 0
+    for day, value in series:
+        steps[day] += sign * (value - previous)
+        previous = value
+    return steps
+
+def apply_investment_steps(c, steps):
+    """Add investment changes that each hold from their day on, turned into one running total per range of days,
+    so every affected row is updated once however many changes there are."""
+    days = sorted(day for day, change in steps.items() if round(change, 2))
+    if not days:
+        return
+    ensure_net_worth_days(c, days[0])
+    last = ensure_net_worth_days(c, days[-1])
+    
+    ranges = []
+    total = 0
+    for day, following in zip(days, days[1:] + [last + 1]):
+        total += steps[day]
+        if round(total, 2):
+            ranges.append((total, total, day, following - 1))
+    c.executemany('''UPDATE net_worth_daily
+                     SET investments = ROUND(investments + ?, 2), net_worth = ROUND(net_worth + ?, 2)
+                     WHERE day BETWEEN ? AND ?''', ranges)
+
+def record_investment_values(c, values):
+    """Store many (investment_id, day, value) entries and apply their net effect on net worth in one pass."""
+    ids = sorted({investment_id for investment_id, _, _ in values})
+    c.execute(f'''SELECT investment_id, day, value FROM investment_values
+                   WHERE investment_id IN ({', '.join('?' for _ in ids)})''', ids)
+    before = {investment_id: {} for investment_id in ids}
+    for investment_id, day, value in c.fetchall():
+        before[investment_id][day] = value
+    after = {investment_id: dict(series) for investment_id, series in before.items()}
+    for investment_id, day, value in values:
+        after[investment_id][day] = value
+    
+    steps = Counter()
+    for investment_id in ids:
+        steps.update(value_steps(sorted(after[investment_id].items())))
+        steps.update(value_steps(sorted(before[investment_id].items()), -1))
+    c.executemany('INSERT OR REPLACE INTO investment_values (investment_id, day, value) VALUES (?, ?, ?)', values)
+    apply_investment_steps(c, steps)
+
+def net_worth_snapshot(c, day: int = None) -> Dict:
+    """The balances on `day` (today by default): one primary key lookup, carried forward over days without writes."""
+    day = day if day is not None else net_worth_today()
+    c.execute('SELECT * FROM net_worth_daily WHERE day <= ? ORDER BY day DESC LIMIT 1', (day,))
+    row = c.fetchone()
+    if not row:
+        return dict.fromkeys(NET_WORTH_COLUMNS, 0.0)
+    row = tuple(row)
+    if row[0] < day:
+        row = carry_net_worth(row, day)[-1]
+    return dict(zip(NET_WORTH_COLUMNS, row[1:]))
+
+def rebuild_net_worth_history(c) -> int:
+    """Recompute net_worth_daily from scratch and return the number of days written.
+    
+    Income, expenses and investment values are dated, so their history is exact. Savings goals and debts only know
+    their current balance, which is counted from the day they were created.
+    """
+    deltas = {}
+    
+    def add(day, column, amount):
+        if day is not None and amount:
+            deltas.setdefault(day, Counter())[column] += amount
+    
+    for day, amount in c.execute(f'SELECT {sql_day("date_added")}, SUM(amount) FROM income GROUP BY 1').fetchall():
+        add(day, 'income', amount)
+    source = expense_source(c.connection)
+    for day, amount in c.execute(f'SELECT {sql_day("date_added")}, SUM(amount) FROM {source} GROUP BY 1').fetchall():
+        add(day, 'expenses', amount)
+    for day, amount in c.execute(f'''SELECT {sql_day("created_at")}, SUM(current_amount) FROM savings_goals
+                                     GROUP BY 1''').fetchall():
+        add(day, 'savings', amount)
+    for day, amount in c.execute(f'''SELECT {sql_day("created_at")}, SUM(remaining_amount) FROM debts
+                                     GROUP BY 1''').fetchall():
+        add(day, 'debts', amount)
+    
+    previous = {}
+    for investment_id, day, value in c.execute('SELECT investment_id, day, value FROM investment_values '
+                                               'ORDER BY investment_id, day').fetchall():
+        add(day, 'investments', value - previous.get(investment_id, 0))
+        previous[investment_id] = value
+    
+    c.execute('DELETE FROM net_worth_daily')
+    if not deltas:
+        return 0
+    
+    rows = [(min(deltas) - 1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)]
+    for day in range(min(deltas), max(max(deltas), net_worth_today()) + 1):
+        row = carry_net_worth(rows[-1], day)[0]
+        delta = deltas.get(day)
+        if delta:
+            income, expenses, investments, savings, debts = (round(row[i + 1] + delta[column], 2)
+                                                             for i, column in enumerate(NET_WORTH_COLUMNS[:5]))
+            row = (day, income, expenses, investments, savings, debts,
+                   round(income - expenses + investments + savings - debts, 2))
+        rows.append(row)
+    
+    c.executemany('INSERT INTO net_worth_daily VALUES (?, ?, ?, ?, ?, ?, ?)', rows[1:])
+    return len(rows) - 1
+
+def backfill_net_worth_history():
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    c.execute('SELECT 1 FROM net_worth_daily LIMIT 1')
+    if c.fetchone() is None:
+        rebuild_net_worth_history(c)
+        conn.commit()
+    conn.close()
+
+backfill_net_worth_history()
+
+@app.cli.command('rebuild-net-worth-history')
+def rebuild_net_worth_history_command():
+    """Recompute the daily net worth history from income, expenses, investments, goals and debts."""
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    days = rebuild_net_worth_history(c)
+    conn.commit()
+    conn.close()
+    print(f"Rebuilt net worth history for {days} days")
+
+COLUMNAR_MIMETYPE = 'application/vnd.budget.columnar+json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+TABLE_FORMATS = {'application/json': 'json', COLUMNAR_MIMETYPE: 'columnar',
+                 MSGPACK_MIMETYPE: 'msgpack', 'application/x-msgpack': 'msgpack'}
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COMPRESSIBLE_MIMETYPES = {'application/json', COLUMNAR_MIMETYPE, MSGPACK_MIMETYPE}
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+
+def table_format() -> str:
+    fmt = request.args.get('format')
+    if fmt not in TABLE_FORMATS.values():
+        fmt = TABLE_FORMATS[request.accept_mimetypes.best_match(list(TABLE_FORMATS), default='application/json')]
+    if fmt == 'msgpack' and not MSGPACK_AVAILABLE:
+        return 'columnar'
+    return fmt
+
+def fetch_table(c, fmt: str):
+    """Rows of an executed cursor: a list of dicts for plain JSON, otherwise columns plus raw tuples."""
+    columns = [d[0] for d in c.description]
+    if fmt == 'json':
+        return [dict(zip(columns, row)) for row in c]
+    return {'columns': columns, 'rows': c.fetchall()}
+
+def encode_json(payload) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+def table_response(payload, fmt: str):
+    if fmt == 'json':
+        response = jsonify(payload)
+    elif fmt == 'msgpack':
+        response = Response(msgpack.packb(payload, use_bin_type=True), mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = Response(encode_json(payload), mimetype=COLUMNAR_MIMETYPE)
+    response.vary.add('Accept')
+    return response
+
+@app.after_request
+def compress_response(response):
+    if response.status_code != 200 or response.is_streamed or response.direct_passthrough \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+    # Small bodies are sent as they are, whatever the client accepts, so only larger ones vary by encoding.
+    if (response.calculate_content_length() or 0) < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if BROTLI_AVAILABLE else ['gzip'])
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+ANOMALY_MIN_SAMPLES = int(os.getenv('ANOMALY_MIN_SAMPLES', 8))
+ANOMALY_Z_SCORE = float(os.getenv('ANOMALY_Z_SCORE', 3.0))
+ANOMALY_QUANTILE = 0.95
+
+class QuantileSketch:
+    """P-squared streaming estimate of a single quantile using five markers."""
+    
+    def __init__(self, p=ANOMALY_QUANTILE, state=None):
+        self.p = p
+        if state:
+            self.q = state['q']
+            self.n = state['n']
+            self.np = state['np']
+        else:
+            self.q = []
+            self.n = [0, 1, 2, 3, 4]
+            self.np = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.dn = [0, p / 2, p, (1 + p) / 2, 1]
+    
+    def to_json(self) -> str:
+        return json.dumps({'q': self.q, 'n': self.n, 'np': self.np})
+    
+    @classmethod
+    def from_json(cls, data, p=ANOMALY_QUANTILE):
+        return cls(p, json.loads(data) if data else None)
+    
+    def value(self):
+        if not self.q:
+            return None
+        if len(self.q) < 5:
+            ordered = sorted(self.q)
+            return ordered[min(len(ordered) - 1, int(self.p * len(ordered)))]
+        return self.q[2]
+    
+    def add(self, x: float):
+        q, n = self.q, self.n
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+        
+        for i in range(1, 4):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                candidate = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if q[i - 1] < candidate < q[i + 1]:
+                    q[i] = candidate
+                else:
+                    q[i] = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+def score_expense(count: int, mean: float, m2: float, sketch: QuantileSketch, amount: float):
+    if count < ANOMALY_MIN_SAMPLES:
+        return None
+    
+    std = (m2 / (count - 1)) ** 0.5
+    if std > 0:
+        z_score = (amount - mean) / std
+    else:
+        z_score = float('inf') if amount > mean else 0.0
+    
+    threshold = sketch.value()
+    if z_score >= ANOMALY_Z_SCORE and threshold is not None and amount > threshold:
+        return {
+            'amount': amount,
+            'mean': round(mean, 2),
+            'z_score': round(z_score, 2) if std > 0 else None,
+            'p95': round(threshold, 2)
+        }
+    return None
+
+def welford_update(count: int, mean: float, m2: float, amount: float):
+    count += 1
+    delta = amount - mean
+    mean += delta / count
+    m2 += delta * (amount - mean)
+    return count, mean, m2
+
+def welford_remove(count: int, mean: float, m2: float, amount: float):
+    if count <= 1:
+        return 0, 0.0, 0.0
+    count -= 1
+    previous = mean
+    mean = (previous * (count + 1) - amount) / count
+    m2 = max(m2 - (amount - mean) * (amount - previous), 0.0)
+    return count, mean, m2
+
+def record_expense_stats_batch(c, expenses):
+    """Score and fold (expense_id, category_id, amount) rows into the category stats, in insert order."""
+    categories = list({category_id for _, category_id, _ in expenses})
+    states = {category_id: (0, 0.0, 0.0, QuantileSketch()) for category_id in categories}
+    c.execute(f'''SELECT category_id, count, mean, m2, sketch FROM category_stats
+                  WHERE category_id IN ({', '.join('?' for _ in categories)})''', categories)
+    for category_id, count, mean, m2, sketch in c.fetchall():
+        states[category_id] = (count, mean, m2, QuantileSketch.from_json(sketch))
+    
+    anomalies = []
+    for expense_id, category_id, amount in expenses:
+        count, mean, m2, sketch = states[category_id]
+        anomaly = score_expense(count, mean, m2, sketch, amount)
+        if anomaly:
+            c.execute('''INSERT OR REPLACE INTO expense_anomalies (expense_id, category_id, amount, mean, z_score)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      (expense_id, category_id, amount, anomaly['mean'], anomaly['z_score']))
+        anomalies.append(anomaly)
+        count, mean, m2 = welford_update(count, mean, m2, amount)
+        sketch.add(amount)
+        states[category_id] = (count, mean, m2, sketch)
+    
+    c.executemany('''INSERT OR REPLACE INTO category_stats (category_id, count, mean, m2, sketch)
+                     VALUES (?, ?, ?, ?, ?)''',
+                  [(cid, count, mean, m2, sketch.to_json()) for cid, (count, mean, m2, sketch) in states.items()])
+    return anomalies
+
+def record_expense_stats(c, expense_id: int, category_id: int, amount: float):
+    return record_expense_stats_batch(c, [(expense_id, category_id, amount)])[0]
+
+def move_expense_stats(c, expense_id: int, amount: float, old_category_id, category_id):
+    """Take a re-categorized expense out of its old category's mean and variance and score it against the new one.
+    The old category's quantile sketch keeps it, since P-squared can't forget a value."""
+    c.execute('DELETE FROM expense_anomalies WHERE expense_id = ?', (expense_id,))
+    if old_category_id is not None:
+        c.execute('SELECT count, mean, m2 FROM category_stats WHERE category_id = ?', (old_category_id,))
+        row = c.fetchone()
+        if row:
+            c.execute('UPDATE category_stats SET count = ?, mean = ?, m2 = ? WHERE category_id = ?',
+                      welford_remove(*row, amount) + (old_category_id,))
+    if category_id is not None and record_expense_stats(c, expense_id, category_id, amount):
+        c.execute('''UPDATE expense_anomalies SET date_added = (SELECT date_added FROM expenses WHERE id = ?)
+                     WHERE expense_id = ?''', (expense_id, expense_id))
+
+@app.cli.command('rebuild-anomaly-stats')
+def rebuild_anomaly_stats():
+    """Recompute per-category statistics and flagged anomalies from expense history."""
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    
+    source = expense_source(conn)
+    states = {}
+    anomalies = []
+    for expense_id, category_id, amount, date_added in c.execute(
+            f'''SELECT id, category_id, amount, date_added FROM {source}
+                WHERE category_id IS NOT NULL ORDER BY date_added, id'''):
+        count, mean, m2, sketch = states.get(category_id) or (0, 0.0, 0.0, QuantileSketch())
+        anomaly = score_expense(count, mean, m2, sketch, amount)
+        if anomaly:
+            anomalies.append((expense_id, category_id, amount, anomaly['mean'], anomaly['z_score'], date_added))
+        count, mean, m2 = welford_update(count, mean, m2, amount)
+        sketch.add(amount)
+        states[category_id] = (count, mean, m2, sketch)
+    
+    c.execute('DELETE FROM category_stats')
+    c.execute('DELETE FROM expense_anomalies')
+    c.executemany('INSERT INTO category_stats (category_id, count, mean, m2, sketch) VALUES (?, ?, ?, ?, ?)',
+                  [(cid, count, mean, m2, sketch.to_json()) for cid, (count, mean, m2, sketch) in states.items()])
+    c.executemany('''INSERT INTO expense_anomalies (expense_id, category_id, amount, mean, z_score, date_added)
+                     VALUES (?, ?, ?, ?, ?, ?)''', anomalies)
+    conn.commit()
+    conn.close()
+    print(f"Rebuilt stats for {len(states)} categories, {len(anomalies)} anomalies flagged")
+
+@app.cli.command('archive-expenses')
+@click.option('--before', type=int, help='Archive every year before this one (defaults to the current year).')
+def archive_expenses(before):
+    """Move expenses from closed years into read-only per-year archive files."""
+    current_year = datetime.now().year
+    before = min(before or current_year, current_year)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    c.execute('''SELECT DISTINCT CAST(strftime('%Y', date_added) AS INTEGER) FROM expenses
+                 WHERE date_added < ? AND strftime('%Y', date_added) IS NOT NULL''', (f'{before}-01-01',))
+    years = sorted(row[0] for row in c.fetchall())
+    c.execute('SELECT year FROM expense_archives')
+    archived_years = {row[0] for row in c.fetchall()} | set(years)
+    limit = attach_limit(conn)
+    if len(archived_years) > limit:
+        conn.close()
+        raise click.ClickException(
+            f"This would leave {len(archived_years)} yearly archives, but reads attach every archive and SQLite "
+            f"allows at most {limit} attached databases. Archive fewer years with --before.")
+    _, kind, code, text_column, category_column, day_column = SEARCH_SOURCES[0]
+    
+    for year in years:
+        start, end = f'{year}-01-01', f'{year + 1}-01-01'
+        path = os.path.join(ARCHIVE_DIR, f'expenses-{year}.db')
+        if os.path.exists(path):
+            os.chmod(path, 0o644)
+        
+        c.execute('ATTACH DATABASE ? AS archive', (path,))
+        c.execute('''CREATE TABLE IF NOT EXISTS archive.expenses
+                     (id INTEGER PRIMARY KEY,
+                      amount REAL NOT NULL,
+                      category_id INTEGER,
+                      description TEXT,
+                      date_added TIMESTAMP,
+                      fingerprint INTEGER,
+                      labelled INTEGER NOT NULL DEFAULT 1)''')
+        if 'labelled' not in {row[1] for row in c.execute('PRAGMA archive.table_info(expenses)')}:
+            c.execute('ALTER TABLE archive.expenses ADD COLUMN labelled INTEGER NOT NULL DEFAULT 1')
+            c.execute('UPDATE archive.expenses SET labelled = 0 WHERE fingerprint IS NOT NULL')
+        c.execute('CREATE INDEX IF NOT EXISTS archive.idx_expenses_date ON expenses(date_added)')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_expenses_fingerprint ON expenses(fingerprint)')
+        c.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS archive.search_index USING fts5 ({SEARCH_INDEX_COLUMNS})')
+        
+        c.execute(f'''INSERT INTO archive.expenses ({EXPENSE_COLUMNS})
+                      SELECT {EXPENSE_COLUMNS} FROM main.expenses WHERE date_added >= ? AND date_added < ?''',
+                  (start, end))
+        moved = c.rowcount
+        c.execute(f'''INSERT INTO archive.search_index (rowid, content, kind, ref_id, category_id, day)
+                      SELECT {search_index_values('e', kind, code, text_column, category_column, day_column)}
+                      FROM main.expenses e
+                      WHERE e.date_added >= ? AND e.date_added < ? AND COALESCE(e.{text_column}, '') <> ''
+                  ''', (start, end))
+        c.execute('DELETE FROM main.expenses WHERE date_added >= ? AND date_added < ?', (start, end))
+        c.execute('SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM archive.expenses')
+        count, total = c.fetchone()
+        c.execute('''INSERT INTO expense_archives (year, path, expense_count, total) VALUES (?, ?, ?, ?)
+                     ON CONFLICT(year) DO UPDATE SET path = excluded.path, expense_count = excluded.expense_count,
+                         total = excluded.total, archived_at = CURRENT_TIMESTAMP''', (year, path, count, total))
+        conn.commit()
+        c.execute('DETACH DATABASE archive')
+        
+        archive = sqlite3.connect(path)
+        archive.execute('VACUUM')
+        archive.close()
+        os.chmod(path, 0o444)
+        print(f"{year}: moved {moved} expenses to {path} ({count} archived in total)")
+    
+    if years:
+        c.execute('VACUUM')
+    conn.close()
+    if not years:
+        print(f"Nothing to archive before {before}")
+
+CATEGORY_KEYWORDS = {
+    'Food': ['food', 'restaurant', 'grocery', 'eat', 'meal', 'cafe', 'pizza', 'burger'],
+    'Transport': ['uber', 'taxi', 'bus', 'train', 'gas', 'fuel', 'parking', 'transport'],
+    'Fun': ['movie', 'game', 'entertainment', 'fun', 'party', 'concert'],
+    'Shopping': ['shop', 'store', 'buy', 'purchase', 'amazon', 'clothes']
+}
+
+CLASSIFIER_NGRAMS = (2, 3, 4)
+CLASSIFIER_BUCKETS = 1 << 20
+CLASSIFIER_ALPHA = 0.5
+CLASSIFIER_MIN_EXAMPLES = int(os.getenv('CLASSIFIER_MIN_EXAMPLES', 10))
+CLASSIFIER_MIN_CONFIDENCE = float(os.getenv('CLASSIFIER_MIN_CONFIDENCE', 0.7))
+CLASSIFIER_TEMPERATURES = [0.1 * 1.25 ** i for i in range(20)]
+DEFAULT_CLASSIFIER_TEMPERATURE = 0.25
+
+def classifier_text(description: str) -> str:
+    return re.sub(r'\d+', '0', normalize_description(description))
+
+@lru_cache(maxsize=8192)
+def description_features(description: str):
+    """Hashed character n-gram counts of a normalized description, as (feature, count) pairs."""
+    text = f' {classifier_text(description)} '
+    if not text.strip():
+        return ()
+    counts = {}
+    for n in CLASSIFIER_NGRAMS:
+        for i in range(len(text) - n + 1):
+            feature = zlib.crc32(text[i:i + n].encode()) % CLASSIFIER_BUCKETS
+            counts[feature] = counts.get(feature, 0) + 1
+    return tuple(counts.items())
+
+class CategoryClassifier:
+    """Multinomial naive Bayes over hashed character n-grams with temperature-scaled probabilities."""
+    
+    def __init__(self, temperature: float = DEFAULT_CLASSIFIER_TEMPERATURE):
+        self.lock = threading.Lock()
+        self.temperature = temperature
+        self.counts = {}
+        self.totals = {}
+        self.documents = {}
+        self.vocabulary = {}
+        self.names = {}
+    
+    def add(self, features, category_id: int, weight: int = 1):
+        with self.lock:
+            counts = self.counts.setdefault(category_id, {})
+            for feature, count in features:
+                for table in (counts, self.vocabulary):
+                    table[feature] = table.get(feature, 0) + count * weight
+                    if table[feature] <= 0:
+                        del table[feature]
+            self.totals[category_id] = self.totals.get(category_id, 0) + weight * sum(count for _, count in features)
+            self.documents[category_id] = self.documents.get(category_id, 0) + weight
+            if self.documents[category_id] <= 0:
+                for table in (self.counts, self.totals, self.documents):
+                    table.pop(category_id, None)
+    
+    def logits(self, features):
+        """Log-posterior per n-gram of every known category, so overlapping n-grams don't compound confidence."""
+        examples = sum(self.documents.values())
+        vocabulary = len(self.vocabulary) + 1
+        length = sum(count for _, count in features)
+        logits = {}
+        for category_id, counts in self.counts.items():
+            denominator = math.log(self.totals[category_id] + CLASSIFIER_ALPHA * vocabulary)
+            logits[category_id] = (math.log(self.documents[category_id] / examples) + sum(
+                count * (math.log(counts.get(feature, 0) + CLASSIFIER_ALPHA) - denominator)
+                for feature, count in features)) / length
+        return logits
+    
+    def best(self, features):
+        """(logits, best category, share of the description's n-grams that category has seen)."""
+        logits = self.logits(features)
+        best = max(logits, key=logits.get)
+        seen = sum(count for feature, count in features if feature in self.counts[best])
+        return logits, best, seen / sum(count for _, count in features)
+    
+    @staticmethod
+    def confidence(logits, best: int, share: float, temperature: float) -> float:
+        """The tempered posterior of `best`, discounted by its n-gram share so unfamiliar text is never confident."""
+        return share / sum(math.exp((value - logits[best]) / temperature) for value in logits.values())
+    
+    def predict(self, features, temperature: float = None):
+        """Best category and its calibrated confidence."""
+        with self.lock:
+            if not features or sum(self.documents.values()) < CLASSIFIER_MIN_EXAMPLES:
+                return None, 0.0
+            logits, best, share = self.best(features)
+        return best, self.confidence(logits, best, share, temperature or self.temperature)
+
+def fit_classifier_temperature(classifier: CategoryClassifier, holdout) -> float:
+    """Temperature minimizing the log loss of the confidence predict() reports, i.e. of whether its best
+    category is right, on held-out examples."""
+    scored = [classifier.best(features) + (category_id,) for features, category_id in holdout if features]
+    if not scored:
+        return DEFAULT_CLASSIFIER_TEMPERATURE
+    
+    def log_loss(temperature):
+        loss = 0.0
+        for logits, best, share, category_id in scored:
+            confidence = min(max(classifier.confidence(logits, best, share, temperature), 1e-9), 1 - 1e-9)
+            loss -= math.log(confidence if best == category_id else 1 - confidence)
+        return loss
+    return min(CLASSIFIER_TEMPERATURES, key=log_loss)
+
+def train_category_model(conn):
+    """Retrain the classifier from labelled expense history, calibrate it on every fifth example and persist it."""
+    c = conn.cursor()
+    source = expense_source(conn)
+    c.execute(f'''SELECT description, category_id FROM {source}
+                  WHERE labelled AND category_id IS NOT NULL AND COALESCE(description, '') <> '' ORDER BY id''')
+    examples = [(description_features(description), category_id) for description, category_id in c.fetchall()]
+    examples = [(features, category_id) for features, category_id in examples if features]
+    
+    classifier = CategoryClassifier()
+    if len(examples) >= 5 * CLASSIFIER_MIN_EXAMPLES:
+        for i, (features, category_id) in enumerate(examples):
+            if i % 5:
+                classifier.add(features, category_id)
+        temperature = fit_classifier_temperature(classifier, examples[::5])
+        classifier = CategoryClassifier(temperature)
+    for features, category_id in examples:
+        classifier.add(features, category_id)
+    
+    c.execute('DELETE FROM category_model_features')
+    c.execute('DELETE FROM category_model_totals')
+    c.executemany('INSERT INTO category_model_features (category_id, feature, count) VALUES (?, ?, ?)',
+                  [(category_id, feature, count) for category_id, counts in classifier.counts.items()
+                   for feature, count in counts.items()])
+    c.executemany('INSERT INTO category_model_totals (category_id, documents, features) VALUES (?, ?, ?)',
+                  [(category_id, classifier.documents[category_id], classifier.totals[category_id])
+                   for category_id in classifier.counts])
+    c.execute("INSERT OR REPLACE INTO category_model_meta (name, value) VALUES ('temperature', ?)",
+              (classifier.temperature,))
+    conn.commit()
+    return classifier, len(examples)
+
+def load_category_model(conn) -> CategoryClassifier:
+    c = conn.cursor()
+    c.execute("SELECT value FROM category_model_meta WHERE name = 'temperature'")
+    row = c.fetchone()
+    if row is None:
+        classifier, _ = train_category_model(conn)
+    else:
+        classifier = CategoryClassifier(row[0])
+        c.execute('SELECT category_id, documents, features FROM category_model_totals')
+        for category_id, documents, features in c.fetchall():
+            classifier.documents[category_id] = documents
+            classifier.totals[category_id] = features
+            classifier.counts[category_id] = {}
+        c.execute('SELECT category_id, feature, count FROM category_model_features')
+        for category_id, feature, count in c.fetchall():
+            classifier.counts.setdefault(category_id, {})[feature] = count
+            classifier.vocabulary[feature] = classifier.vocabulary.get(feature, 0) + count
+    
+    c.execute('SELECT id, name FROM categories')
+    classifier.names = dict(c.fetchall())
+    return classifier
+
+category_classifier = None
+category_classifier_lock = threading.Lock()
+
+def get_category_classifier() -> CategoryClassifier:
+    """The shared classifier, loaded (or trained from history) on first use; call it outside write transactions."""
+    global category_classifier
+    with category_classifier_lock:
+        if category_classifier is None:
+            conn = sqlite3.connect(DATABASE)
+            category_classifier = load_category_model(conn)
+            conn.close()
+        return category_classifier
+
+def learn_categories(c, examples, weight: int = 1):
+    """Add (weight=1) or remove (weight=-1) labelled (description, category_id) examples on disk. Returns the
+    matching in-memory update, for apply_learned() once the write has committed."""
+    updates = []
+    feature_deltas = {}
+    total_deltas = {}
+    for description, category_id in examples:
+        features = description_features(description or '')
+        if not features or category_id is None:
+            continue
+        updates.append((features, category_id, weight))
+        for feature, count in features:
+            feature_deltas[category_id, feature] = feature_deltas.get((category_id, feature), 0) + count * weight
+        documents, total = total_deltas.get(category_id, (0, 0))
+        total_deltas[category_id] = (documents + weight, total + weight * sum(count for _, count in features))
+    
+    c.executemany('''INSERT INTO category_model_features (category_id, feature, count) VALUES (?, ?, ?)
+                     ON CONFLICT(category_id, feature) DO UPDATE SET count = count + excluded.count''',
+                  [(category_id, feature, delta) for (category_id, feature), delta in feature_deltas.items()])
+    c.executemany('''INSERT INTO category_model_totals (category_id, documents, features) VALUES (?, ?, ?)
+                     ON CONFLICT(category_id) DO UPDATE SET documents = documents + excluded.documents,
+                         features = features + excluded.features''',
+                  [(category_id, documents, total) for category_id, (documents, total) in total_deltas.items()])
+    if weight < 0:
+        c.executemany('DELETE FROM category_model_features WHERE category_id = ? AND feature = ? AND count <= 0',
+                      list(feature_deltas))
+        c.executemany('DELETE FROM category_model_totals WHERE category_id = ? AND documents <= 0',
+                      [(category_id,) for category_id in total_deltas])
+    return updates
+
+def learn_category(c, description: str, category_id: int, weight: int = 1):
+    return learn_categories(c, [(description, category_id)], weight)
+
+def apply_learned(updates):
+    classifier = get_category_classifier()
+    for features, category_id, weight in updates:
+        classifier.add(features, category_id, weight)
+
+def classify_locally(description: str):
+    """(category name, confidence, source): the classifier when it is confident, else keyword rules."""
+    classifier = get_category_classifier()
+    category_id, confidence = classifier.predict(description_features(description or ''))
+    if category_id is not None and category_id not in classifier.names:
+        conn = sqlite3.connect(DATABASE)
+        classifier.names = dict(conn.execute('SELECT id, name FROM categories').fetchall())
+        conn.close()
+    name = classifier.names.get(category_id)
+    if name and confidence >= CLASSIFIER_MIN_CONFIDENCE:
+        return name, confidence, 'model'
+    
+    desc_lower = (description or '').lower()
+    for category, words in CATEGORY_KEYWORDS.items():
+        if any(word in desc_lower for word in words):
+            return category, None, 'keywords'
+    if name:
+        return name, confidence, 'model'
+    return 'Other', None, 'keywords'
+
+@app.cli.command('train-category-model')
+def train_category_model_command():
+    """Retrain and recalibrate the local expense classifier from history."""
+    global category_classifier
+    conn = sqlite3.connect(DATABASE)
+    classifier, examples = train_category_model(conn)
+    conn.close()
+    with category_classifier_lock:
+        category_classifier = None
+    print(f"Trained on {examples} expenses across {len(classifier.counts)} categories "
+          f"(temperature {classifier.temperature:.2f})")
+
+def categorize_locally(description: str) -> str:
+    return classify_locally(description)[0]
+
 def get_api_key():
     api_key = os.getenv('OPENAI_API_KEY') or os.environ.get('OPENAI_API_KEY')
     
@@ -120,7 +1338,7 @@ def get_api_key():
                             if '=' in line:
                                 api_key = line.split('=', 1)[1].strip()
                                 break
-            except:
+            except OSError:
                 pass
     
     if api_key:
@@ -130,75 +1348,312 @@ def get_api_key():
     
     return api_key
 
-def get_ai_response(user_message: str, user_data: Dict) -> str:
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 30))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 2))
+
+openai_clients = {}
+
+def get_openai_client(api_key: str):
+    if api_key not in openai_clients:
+        openai_clients[api_key] = openai.OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL,
+                                                timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+    return openai_clients[api_key]
+
+def token_usage(usage) -> Dict:
+    return {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens}
+
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', 8))
+LLM_QUEUE_SIZE = int(os.getenv('LLM_QUEUE_SIZE', 32))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', 10))
+LLM_CLIENT_RATE = float(os.getenv('LLM_CLIENT_RATE', 1))
+LLM_CLIENT_BURST = float(os.getenv('LLM_CLIENT_BURST', 10))
+LLM_MAX_CLIENTS = 10000
+ADMISSION_PRIORITIES = {'chat': 0, 'predict': 1, 'recommendations': 2, 'categorize': 3}
+
+class AdmissionController:
+    """Gatekeeper for outstanding LLM calls, shared by the threaded and async handlers.
+    
+    Each client spends tokens from its own bucket (LLM_CLIENT_RATE per second, up to LLM_CLIENT_BURST). At most
+    LLM_CONCURRENCY calls run at once; the rest wait in a priority queue of LLM_QUEUE_SIZE where chat goes first.
+    Requests that can't get in are shed with the number of seconds to wait before retrying.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queue = []
+        self.depth = 0
+        self.max_depth = 0
+        self.sequence = itertools.count()
+        self.buckets = {}
+        self.call_seconds = 1.0
+        self.waits = deque(maxlen=1024)
+        self.counts = Counter()
+    
+    def take_token(self, client: str, now: float) -> int:
+        if len(self.buckets) > LLM_MAX_CLIENTS:
+            self.buckets = {key: (tokens, updated) for key, (tokens, updated) in self.buckets.items()
+                            if tokens + (now - updated) * LLM_CLIENT_RATE < LLM_CLIENT_BURST}
+        tokens, updated = self.buckets.get(client, (LLM_CLIENT_BURST, now))
+        tokens = min(LLM_CLIENT_BURST, tokens + (now - updated) * LLM_CLIENT_RATE)
+        if tokens < 1:
+            self.buckets[client] = (tokens, now)
+            return max(1, math.ceil((1 - tokens) / LLM_CLIENT_RATE))
+        self.buckets[client] = (tokens - 1, now)
+        return 0
+    
+    def retry_after(self) -> int:
+        return max(1, math.ceil((self.depth + 1) * self.call_seconds / LLM_CONCURRENCY))
+    
+    def enter(self, kind: str, client, wake):
+        """('admitted', None), ('queued', entry) - wake(0) is called once a slot is handed over, or wake(seconds)
+        if a more urgent request pushes it out - or ('shed', seconds to wait before retrying)."""
+        now = time.monotonic()
+        priority = ADMISSION_PRIORITIES[kind]
+        with self.lock:
+            if client is not None:
+                wait = self.take_token(client, now)
+                if wait:
+                    self.counts['shed_rate_limited'] += 1
+                    return 'shed', wait
+            
+            if self.active < LLM_CONCURRENCY:
+                self.active += 1
+                self.counts['admitted'] += 1
+                self.waits.append(0.0)
+                return 'admitted', None
+            
+            if self.depth >= LLM_QUEUE_SIZE:
+                victim = max((entry for entry in self.queue if entry[3]), default=None)
+                if victim is None or victim[0] <= priority:
+                    self.counts['shed_queue_full'] += 1
+                    return 'shed', self.retry_after()
+                evicted, victim[3] = victim[3], None
+                self.depth -= 1
+                self.counts['shed_evicted'] += 1
+                evicted(self.retry_after())
+            
+            entry = [priority, next(self.sequence), now, wake, kind]
+            heapq.heappush(self.queue, entry)
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.counts['queued'] += 1
+            return 'queued', entry
+    
+    def cancel(self, entry) -> bool:
+        """Drop a queued request that gave up waiting; False if it was already woken."""
+        with self.lock:
+            if entry[3] is None:
+                return False
+            entry[3] = None
+            self.depth -= 1
+            self.counts['shed_timeout'] += 1
+            return True
+    
+    def release(self, seconds=None):
+        """Free a slot after an LLM call that took `seconds`, handing it straight to the most urgent waiter."""
+        with self.lock:
+            if seconds is not None:
+                self.call_seconds = 0.8 * self.call_seconds + 0.2 * seconds
+            while self.queue:
+                entry = heapq.heappop(self.queue)
+                if entry[3] is None:
+                    continue
+                wake, entry[3] = entry[3], None
+                self.depth -= 1
+                self.counts['admitted'] += 1
+                self.waits.append(time.monotonic() - entry[2])
+                wake(0)
+                return
+            self.active -= 1
+    
+    def acquire(self, kind: str, client=None) -> int:
+        """Block until this thread holds a slot (returns 0) or the request is shed (returns Retry-After seconds)."""
+        done = threading.Event()
+        outcome = []
+        
+        def wake(retry_after):
+            outcome.append(retry_after)
+            done.set()
+        
+        status, value = self.enter(kind, client, wake)
+        if status == 'admitted':
+            return 0
+        if status == 'shed':
+            return value
+        if not done.wait(LLM_QUEUE_TIMEOUT) and self.cancel(value):
+            return self.retry_after()
+        done.wait()
+        return outcome[0]
+    
+    def metrics(self) -> Dict:
+        with self.lock:
+            waits = sorted(self.waits)
+            queued = Counter(entry[4] for entry in self.queue if entry[3])
+            return {
+                'active': self.active,
+                'capacity': LLM_CONCURRENCY,
+                'queue_depth': self.depth,
+                'queue_capacity': LLM_QUEUE_SIZE,
+                'max_queue_depth': self.max_depth,
+                'queued_by_kind': dict(queued),
+                'wait_ms': {f'p{p}': round(waits[min(len(waits) - 1, len(waits) * p // 100)] * 1000, 1) if waits else 0
+                            for p in (50, 95, 99)},
+                'avg_call_seconds': round(self.call_seconds, 3),
+                'clients': len(self.buckets),
+                **{key: self.counts[key] for key in ('admitted', 'queued', 'shed_rate_limited', 'shed_queue_full',
+                                                     'shed_evicted', 'shed_timeout')}
+            }
+
+admission = AdmissionController()
+
+def request_client():
+    return request.headers.get('X-Client-Id') or request.remote_addr
+
+def admit_llm_call(kind: str) -> bool:
+    """Wait for an LLM slot; False if the call was shed, in which case the response gets a Retry-After header."""
+    client = request_client() if has_request_context() else None
+    retry_after = admission.acquire(kind, client)
+    if retry_after and has_request_context():
+        g.retry_after = retry_after
+    return not retry_after
+
+@app.after_request
+def add_retry_after(response):
+    if g.get('retry_after'):
+        response.headers['Retry-After'] = str(g.retry_after)
+    return response
+
+def completion_reply(response):
+    """(text, usage) of a chat completion; a response without choices or content is no reply."""
+    message = response.choices[0].message if response.choices else None
+    text = ((message.content if message else None) or '').strip()
+    return text or None, token_usage(response.usage) if response.usage else None
+
+def openai_completion(messages, max_tokens: int, temperature: float, kind: str):
+    """Returns (text, usage) from the configured OpenAI endpoint, or (None, None) if there's no key, the call was shed
+    by admission control, or it failed."""
     api_key = get_api_key()
+    if not (api_key and OPENAI_AVAILABLE) or not admit_llm_call(kind):
+        return None, None
     
-    if api_key and OPENAI_AVAILABLE:
-        try:
-            return get_openai_response(user_message, user_data, api_key)
-        except Exception as e:
-            print(f"OpenAI error: {e}")
-            return get_rule_based_response(user_message, user_data)
+    started = time.monotonic()
+    try:
+        response = get_openai_client(api_key).chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        return completion_reply(response)
+    except openai.OpenAIError as e:
+        print(f"OpenAI error: {e}")
+        return None, None
+    finally:
+        admission.release(time.monotonic() - started)
+
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 300))
+PROMPT_TOP_N = int(os.getenv('PROMPT_TOP_N', 5))
+PROMPT_SECTIONS = ('spending', 'goals', 'investments', 'debts')
+DEFAULT_CHAT_INTENTS = ('spending', 'goals')
+CHAT_INTENTS = {
+    'spending': ['spend', 'spent', 'expense', 'budget', 'categor', 'food', 'eat', 'shop', 'afford', 'too much', 'cut'],
+    'goals': ['save', 'saving', 'goal', 'target', 'afford', 'buy'],
+    'investments': ['invest', 'stock', 'fund', 'etf', 'crypto', 'portfolio', 'net worth'],
+    'debts': ['debt', 'loan', 'owe', 'credit', 'interest', 'pay off', 'net worth'],
+}
+
+@lru_cache(maxsize=1)
+def token_encoding():
+    try:
+        return tiktoken.get_encoding('o200k_base')
+    except Exception:
+        return None
+
+def count_tokens(text: str) -> int:
+    encoding = token_encoding() if TIKTOKEN_AVAILABLE else None
+    if encoding:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+def detect_chat_intents(message: str):
+    message_lower = (message or '').lower()
+    intents = [section for section in PROMPT_SECTIONS
+               if any(word in message_lower for word in CHAT_INTENTS[section])]
+    return intents or list(DEFAULT_CHAT_INTENTS)
+
+def prompt_section(section: str, user_data: Dict):
+    """Header line, (line, amount) items in priority order, and the item count and amount they are drawn from."""
+    if section == 'spending':
+        spending = sorted(user_data.get('category_spending', {}).items(), key=lambda item: (-item[1], item[0]))
+        budgets = user_data.get('category_budgets', {})
+        items = [(f"- {name}: ${amount:.2f} of ${budgets.get(name, 0):.2f} limit", amount) for name, amount in spending]
+        return 'Spending by category:', items, len(items), user_data.get('total_expenses', 0)
+    
+    data = user_data.get(section) or {}
+    count, total = data.get('count', 0), data.get('total', 0)
+    if section == 'goals':
+        header = f"Savings goals ({count}): ${data.get('saved', 0):.2f} saved of ${total:.2f}"
+        items = [(f"- {name}: ${current:.2f}/${target:.2f}" + (f" by {deadline}" if deadline else ''), target)
+                 for name, target, current, deadline in data.get('top', [])]
+    elif section == 'investments':
+        header = f"Investments ({count}): worth ${total:.2f}"
+        items = [(f"- {name} ({kind}): ${value:.2f}", value) for name, kind, value in data.get('top', [])]
     else:
-        return get_rule_based_response(user_message, user_data)
+        header = f"Debts ({count}): ${total:.2f} owed"
+        items = [(f"- {name}: ${remaining:.2f} at {rate:g}%", remaining) for name, remaining, rate in data.get('top', [])]
+    return header, items, count, total
 
-def get_openai_response(user_message: str, user_data: Dict, api_key: str = None) -> str:
-    if not OPENAI_AVAILABLE:
-        return get_rule_based_response(user_message, user_data)
-    
-    if not api_key:
-        api_key = os.getenv('OPENAI_API_KEY')
-    if not api_key:
-        return get_rule_based_response(user_message, user_data)
+def build_chat_context(user_message: str, user_data: Dict, token_budget: int = PROMPT_TOKEN_BUDGET):
+    """Compact, deterministic summary of the user's finances for the sections the question is about."""
+    lines = [f"This month: income ${user_data.get('total_income', 0):.2f}, spent ${user_data.get('total_expenses', 0):.2f}, "
+             f"left ${user_data.get('remaining_budget', 0):.2f}. Net worth ${user_data.get('net_worth', 0):.2f}."]
+    used = count_tokens(lines[0])
+    sections = []
+    
+    for section in detect_chat_intents(user_message):
+        header, items, count, total = prompt_section(section, user_data)
+        cost = count_tokens(header)
+        if used + cost > token_budget:
+            continue
+        lines.append(header)
+        used += cost
+        sections.append(section)
+        
+        for line, amount in items[:PROMPT_TOP_N]:
+            cost = count_tokens(line)
+            if used + cost > token_budget:
+                break
+            lines.append(line)
+            used += cost
+            count -= 1
+            total -= amount
+        
+        rest = f"- {count} more totaling ${total:.2f}"
+        if count > 0 and used + count_tokens(rest) <= token_budget:
+            lines.append(rest)
+            used += count_tokens(rest)
     
+    return '\n'.join(lines), sections
+
+def build_chat_messages(user_message: str, user_data: Dict):
     system_prompt = """You're a helpful budgeting assistant for teens. Give practical, encouraging advice in simple language. Keep it short and friendly."""
+    context, sections = build_chat_context(user_message, user_data)
     
-    category_spending = user_data.get('category_spending', {})
-    spending_breakdown = "\n".join([f"  - {cat}: ${amt:.2f}" for cat, amt in category_spending.items()])
-    
-    context = f"""User's finances:
-    - Income: ${user_data.get('total_income', 0):.2f}
-    - Expenses: ${user_data.get('total_expenses', 0):.2f}
-    - Remaining: ${user_data.get('remaining_budget', 0):.2f}
-    - Spending: {spending_breakdown if spending_breakdown else "  - No expenses yet"}
-    - Top Category: {user_data.get('top_category', 'N/A')}
-    - Goals: {user_data.get('savings_goals', [])}
-    """
-    
-    try:
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "system", "content": context},
-                    {"role": "user", "content": user_message}
-                ],
-                max_tokens=300,
-                temperature=0.8
-            )
-            return response.choices[0].message.content.strip()
-        except:
-            try:
-                openai.api_key = api_key
-                response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "system", "content": context},
-                        {"role": "user", "content": user_message}
-                    ],
-                    max_tokens=300,
-                    temperature=0.8
-                )
-                return response.choices[0].message.content.strip()
-            except:
-                return get_rule_based_response(user_message, user_data)
-    except Exception as e:
-        print(f"OpenAI error: {e}")
-        return get_rule_based_response(user_message, user_data)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": f"User's finances:\n{context}"},
+        {"role": "user", "content": user_message}
+    ]
+    usage = {
+        'prompt_tokens': sum(count_tokens(message['content']) + 3 for message in messages) + 3,
+        'context_tokens': count_tokens(context),
+        'token_budget': PROMPT_TOKEN_BUDGET,
+        'sections': sections
+    }
+    return messages, usage
 
 def get_rule_based_response(user_message: str, user_data: Dict) -> str:
     message_lower = user_message.lower()
@@ -266,15 +1721,19 @@ def health():
 
 @app.route('/api/income', methods=['GET'])
 def get_income():
+    fmt = table_format()
     conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute('SELECT * FROM income ORDER BY date_added DESC')
-    income_records = [dict(row) for row in c.fetchall()]
+    income_records = fetch_table(c, fmt)
     conn.close()
     
-    total = sum(record['amount'] for record in income_records)
-    return jsonify({'income': income_records, 'total': total})
+    if fmt == 'json':
+        total = sum(record['amount'] for record in income_records)
+    else:
+        amount = income_records['columns'].index('amount')
+        total = sum(row[amount] for row in income_records['rows'])
+    return table_response({'income': income_records, 'total': total}, fmt)
 
 @app.route('/api/income', methods=['POST'])
 def add_income():
@@ -283,23 +1742,27 @@ def add_income():
     source = data.get('source', 'Other')
     period = data.get('period', 'monthly')
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('INSERT INTO income (amount, source, period) VALUES (?, ?, ?)',
-              (amount, source, period))
-    conn.commit()
-    income_id = c.lastrowid
-    conn.close()
+    def insert(c):
+        c.execute('INSERT INTO income (amount, source, period) VALUES (?, ?, ?)', (amount, source, period))
+        income_id = c.lastrowid
+        c.execute(f'SELECT {sql_day("date_added")} FROM income WHERE id = ?', (income_id,))
+        apply_net_worth_delta(c, c.fetchone()[0], income=amount)
+        return income_id
+    
+    income_id = write(insert)
     
     return jsonify({'id': income_id, 'amount': amount, 'source': source, 'period': period}), 201
 
 @app.route('/api/income/<int:income_id>', methods=['DELETE'])
 def delete_income(income_id):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('DELETE FROM income WHERE id = ?', (income_id,))
-    conn.commit()
-    conn.close()
+    def delete(c):
+        c.execute(f'SELECT {sql_day("date_added")}, amount FROM income WHERE id = ?', (income_id,))
+        row = c.fetchone()
+        c.execute('DELETE FROM income WHERE id = ?', (income_id,))
+        if row:
+            apply_net_worth_delta(c, row[0], income=-row[1])
+    
+    write(delete)
     return jsonify({'message': 'Income deleted'}), 200
 
 @app.route('/api/categories', methods=['GET'])
@@ -319,17 +1782,11 @@ def add_category():
     budget_limit = float(data.get('budget_limit', 0))
     color = data.get('color', '#3B82F6')
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
     try:
-        c.execute('INSERT INTO categories (name, budget_limit, color) VALUES (?, ?, ?)',
-                  (name, budget_limit, color))
-        conn.commit()
-        category_id = c.lastrowid
-        conn.close()
+        category_id = write(lambda c: c.execute('INSERT INTO categories (name, budget_limit, color) VALUES (?, ?, ?)',
+                                                (name, budget_limit, color)).lastrowid)
         return jsonify({'id': category_id, 'name': name, 'budget_limit': budget_limit, 'color': color}), 201
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({'error': 'Category already exists'}), 400
 
 @app.route('/api/categories/<int:category_id>', methods=['PUT'])
@@ -337,19 +1794,16 @@ def update_category(category_id):
     data = request.json
     budget_limit = float(data.get('budget_limit', 0))
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('UPDATE categories SET budget_limit = ? WHERE id = ?', (budget_limit, category_id))
-    conn.commit()
-    conn.close()
+    write(lambda c: c.execute('UPDATE categories SET budget_limit = ? WHERE id = ?', (budget_limit, category_id)))
+    refresh_alert_levels(category_id=category_id)
     return jsonify({'message': 'Category updated'}), 200
 
 @app.route('/api/expenses', methods=['GET'])
 def get_expenses():
     period = request.args.get('period', 'month')
+    fmt = table_format()
     
     conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
     if period == 'month':
@@ -359,14 +1813,16 @@ def get_expenses():
     else:
         start_date = '2020-01-01'
     
-    c.execute('''SELECT e.*, c.name as category_name, c.color as category_color
-                 FROM expenses e
-                 LEFT JOIN categories c ON e.category_id = c.id
-                 WHERE date(e.date_added) >= ?
-                 ORDER BY e.date_added DESC''', (start_date,))
-    expenses = [dict(row) for row in c.fetchall()]
+    source = expense_source(conn, start_date)
+    c.execute(f'''SELECT e.id, e.amount, e.category_id, e.description, e.date_added,
+                         c.name as category_name, c.color as category_color
+                  FROM {source} e
+                  LEFT JOIN categories c ON e.category_id = c.id
+                  WHERE date(e.date_added) >= ?
+                  ORDER BY e.date_added DESC''', (start_date,))
+    expenses = fetch_table(c, fmt)
     conn.close()
-    return jsonify(expenses)
+    return table_response(expenses, fmt)
 
 @app.route('/api/expenses', methods=['POST'])
 def add_expense():
@@ -375,29 +1831,473 @@ def add_expense():
     category_id = int(data.get('category_id'))
     description = data.get('description', '')
     
+    def insert(c):
+        c.execute('INSERT INTO expenses (amount, category_id, description) VALUES (?, ?, ?)',
+                  (amount, category_id, description))
+        expense_id = c.lastrowid
+        c.execute(f'SELECT {sql_day("date_added")} FROM expenses WHERE id = ?', (expense_id,))
+        apply_net_worth_delta(c, c.fetchone()[0], expenses=amount)
+        anomaly = record_expense_stats(c, expense_id, category_id, amount)
+        return expense_id, anomaly, learn_category(c, description, category_id)
+    
+    get_category_classifier()
+    expense_id, anomaly, learned = write(insert)
+    apply_learned(learned)
+    
     conn = sqlite3.connect(DATABASE)
     c = conn.cursor()
-    c.execute('INSERT INTO expenses (amount, category_id, description) VALUES (?, ?, ?)',
-              (amount, category_id, description))
-    conn.commit()
-    expense_id = c.lastrowid
+    refresh_alert_levels(c, category_id)
+    if anomaly:
+        c.execute('SELECT name FROM categories WHERE id = ?', (category_id,))
+        row = c.fetchone()
+        alert_bus.publish('anomaly', anomaly_alert(expense_id, row[0] if row else '', description,
+                                                   amount, anomaly['mean']))
     conn.close()
     
-    return jsonify({'id': expense_id, 'amount': amount, 'category_id': category_id, 'description': description}), 201
+    return jsonify({'id': expense_id, 'amount': amount, 'category_id': category_id, 'description': description,
+                    'anomaly': anomaly}), 201
+
+def archived_expense(expense_id: int) -> bool:
+    """Whether the expense was moved to one of the read-only yearly archives."""
+    conn = sqlite3.connect(DATABASE)
+    archived = any(conn.execute(f'SELECT 1 FROM {schema}.expenses WHERE id = ?', (expense_id,)).fetchone()
+                   for schema in attach_archives(conn))
+    conn.close()
+    return archived
+
+def missing_expense(expense_id: int):
+    if archived_expense(expense_id):
+        return jsonify({'error': 'Archived expenses are read-only'}), 409
+    return jsonify({'error': 'Expense not found'}), 404
 
 @app.route('/api/expenses/<int:expense_id>', methods=['DELETE'])
 def delete_expense(expense_id):
+    def delete(c):
+        c.execute(f'''SELECT category_id, description, amount, {sql_day("date_added")}, labelled FROM expenses
+                      WHERE id = ?''', (expense_id,))
+        row = c.fetchone()
+        if not row:
+            return None, []
+        c.execute('DELETE FROM expenses WHERE id = ?', (expense_id,))
+        c.execute('DELETE FROM expense_anomalies WHERE expense_id = ?', (expense_id,))
+        apply_net_worth_delta(c, row[3], expenses=-row[2])
+        learned = learn_category(c, row[1], row[0], -1) if row[0] is not None and row[4] else []
+        return row, learned
+    
+    get_category_classifier()
+    row, learned = write(delete)
+    if not row:
+        return missing_expense(expense_id)
+    
+    apply_learned(learned)
+    if row[0] is not None:
+        refresh_alert_levels(category_id=row[0])
+    return jsonify({'message': 'Expense deleted'}), 200
+
+@app.route('/api/expenses/<int:expense_id>', methods=['PUT'])
+def update_expense(expense_id):
+    data = request.json or {}
+    if 'category_id' in data:
+        try:
+            new_category_id = int(data['category_id'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'category_id must be an integer'}), 400
+        conn = sqlite3.connect(DATABASE)
+        known = conn.execute('SELECT 1 FROM categories WHERE id = ?', (new_category_id,)).fetchone()
+        conn.close()
+        if not known:
+            return jsonify({'error': 'Unknown category'}), 400
+    
+    def update(c):
+        c.execute('SELECT category_id, description, labelled, amount FROM expenses WHERE id = ?', (expense_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        
+        old_category_id, old_description, was_labelled, amount = row
+        category_id = new_category_id if 'category_id' in data else old_category_id
+        description = data.get('description', old_description)
+        # A category the user picks is a label, even if it confirms the one an import guessed.
+        labelled = bool(was_labelled or 'category_id' in data)
+        c.execute('UPDATE expenses SET category_id = ?, description = ?, labelled = ? WHERE id = ?',
+                  (category_id, description, labelled, expense_id))
+        changed = (category_id, description) != (old_category_id, old_description)
+        learned = []
+        if was_labelled and changed:
+            learned += learn_category(c, old_description, old_category_id, -1)
+        if labelled and (changed or not was_labelled):
+            learned += learn_category(c, description, category_id)
+        if category_id != old_category_id:
+            move_expense_stats(c, expense_id, amount, old_category_id, category_id)
+        return old_category_id, category_id, description, learned
+    
+    get_category_classifier()
+    updated = write(update)
+    if not updated:
+        return missing_expense(expense_id)
+    
+    old_category_id, category_id, description, learned = updated
+    apply_learned(learned)
+    for touched in {old_category_id, category_id} - {None}:
+        refresh_alert_levels(category_id=touched)
+    return jsonify({'id': expense_id, 'category_id': category_id, 'description': description}), 200
+
+SEARCH_DETAIL_QUERIES = {
+    'expense': '''SELECT e.id, e.amount, e.date_added, c.name as category_name
+                   FROM {expenses} e LEFT JOIN categories c ON e.category_id = c.id
+                   WHERE e.id IN ({ids})''',
+    'recurring': '''SELECT r.id, r.amount, r.next_due_date as date_added, c.name as category_name
+                     FROM recurring_expenses r LEFT JOIN categories c ON r.category_id = c.id
+                     WHERE r.id IN ({ids})''',
+    'income': '''SELECT id, amount, date_added, NULL as category_name
+                  FROM income WHERE id IN ({ids})'''
+}
+
+def build_match_query(query: str):
+    terms = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{term}"*' for term in terms)
+
+@app.route('/api/search', methods=['GET'])
+def search():
+    match = build_match_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({'error': 'Search query is required'}), 400
+    
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        category_id = int(request.args['category_id']) if request.args.get('category_id') else None
+    except ValueError:
+        return jsonify({'error': 'limit and category_id must be integers'}), 400
+    
+    conditions = ['search_index MATCH ?']
+    params = [match]
+    
+    kinds = request.args['type'].split(',') if request.args.get('type') else list(SEARCH_DETAIL_QUERIES)
+    if request.args.get('type'):
+        conditions.append(f"kind IN ({', '.join('?' for _ in kinds)})")
+        params.extend(kinds)
+    if category_id is not None:
+        conditions.append('category_id = ?')
+        params.append(category_id)
+    if request.args.get('from'):
+        conditions.append('day >= ?')
+        params.append(request.args['from'])
+    if request.args.get('to'):
+        conditions.append('day <= ?')
+        params.append(request.args['to'])
+    
+    page = ''
+    page_params = []
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            last_source, last_score, last_rowid = cursor.split(':')
+            page_params = [int(last_source), float(last_score), int(last_rowid)]
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        page = 'WHERE (source, score, entry_id) > (?, ?, ?)'
+    
     conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
     c = conn.cursor()
-    c.execute('DELETE FROM expenses WHERE id = ?', (expense_id,))
+    
+    # bm25 scores depend on each index's own statistics, so they are only comparable within one index: live matches
+    # are ranked first, then each archive's, newest year first.
+    schemas = ['main']
+    if 'expense' in kinds:
+        schemas += reversed(attach_archives(conn, request.args.get('from'), request.args.get('to')))
+    sources = ' UNION ALL '.join(f'''SELECT {rank} as source, rowid as entry_id, kind, ref_id, category_id, day,
+                                            content, bm25(search_index) as score
+                                     FROM {schema}.search_index
+                                     WHERE {' AND '.join(conditions)}''' for rank, schema in enumerate(schemas))
+    c.execute(f'''SELECT * FROM ({sources}) {page}
+                  ORDER BY source, score, entry_id
+                  LIMIT ?''', params * len(schemas) + page_params + [limit + 1])
+    matches = c.fetchall()
+    has_more = len(matches) > limit
+    matches = matches[:limit]
+    
+    expenses = expense_source(conn, request.args.get('from'), request.args.get('to')) if len(schemas) > 1 else 'expenses'
+    details = {}
+    for kind, query in SEARCH_DETAIL_QUERIES.items():
+        ids = [row['ref_id'] for row in matches if row['kind'] == kind]
+        if ids:
+            c.execute(query.format(ids=', '.join('?' for _ in ids), expenses=expenses), ids)
+            details.update({(kind, row['id']): dict(row) for row in c.fetchall()})
+    
+    conn.close()
+    
+    results = []
+    for row in matches:
+        detail = details.get((row['kind'], row['ref_id']), {})
+        results.append({
+            'type': row['kind'],
+            'id': row['ref_id'],
+            'text': row['content'],
+            'date': row['day'],
+            'category_id': row['category_id'],
+            'category_name': detail.get('category_name'),
+            'amount': detail.get('amount'),
+            'score': row['score']
+        })
+    
+    next_cursor = f"{matches[-1]['source']}:{matches[-1]['score']!r}:{matches[-1]['entry_id']}" if has_more else None
+    return jsonify({'results': results, 'next_cursor': next_cursor})
+
+IMPORT_BATCH_SIZE = 5000
+IMPORT_CHUNK_BYTES = 1 << 16
+IMPORT_DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y', '%m/%d/%y', '%Y/%m/%d', '%d.%m.%Y', '%Y%m%d')
+IMPORT_COLUMN_GUESSES = {
+    'date': ['date', 'transaction date', 'posted date', 'posting date', 'booking date'],
+    'amount': ['amount', 'transaction amount', 'value'],
+    'description': ['description', 'payee', 'merchant', 'name', 'memo', 'details'],
+    'debit': ['debit', 'withdrawal', 'money out'],
+    'category': ['category']
+}
+
+def parse_import_amount(value, decimal: str = '.'):
+    text = (value or '').strip().replace('$', '').replace(' ', '')
+    if decimal == ',':
+        text = text.replace('.', '').replace(',', '.')
+    else:
+        text = text.replace(',', '')
+    if not text:
+        return None
+    negative = text.startswith('(') and text.endswith(')')
+    amount = float(text.strip('()'))
+    return -amount if negative else amount
+
+@lru_cache(maxsize=4096)
+def parse_import_date(value, date_format=None):
+    text = (value or '').strip().split(' ')[0].split('T')[0]
+    for fmt in ([date_format] if date_format else IMPORT_DATE_FORMATS):
+        try:
+            return datetime.strptime(text, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+def normalize_description(description: str) -> str:
+    return ' '.join(re.sub(r'[^\w\s]', ' ', (description or '').lower()).split())
+
+def transaction_fingerprint(day: str, amount: float, description: str, occurrence: int) -> int:
+    digest = hashlib.blake2b(f"{day}|{amount:.2f}|{normalize_description(description)}|{occurrence}".encode(),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def read_lines(f, progress):
+    for line in f:
+        progress['bytes_read'] += len(line)
+        yield line.decode('utf-8', errors='replace').lstrip('\ufeff')
+
+def iter_csv_transactions(f, mapping, progress):
+    reader = csv.reader(read_lines(f, progress), delimiter=mapping.get('delimiter', ','))
+    columns = {}
+    if mapping.get('has_header', True):
+        header = [h.strip().lower() for h in next(reader, [])]
+        for field, guesses in IMPORT_COLUMN_GUESSES.items():
+            wanted = mapping.get(field)
+            if isinstance(wanted, int):
+                columns[field] = wanted
+            elif wanted:
+                columns[field] = header.index(wanted.strip().lower()) if wanted.strip().lower() in header else None
+            else:
+                columns[field] = next((header.index(g) for g in guesses if g in header), None)
+    else:
+        columns = {field: mapping.get(field) for field in IMPORT_COLUMN_GUESSES}
+    
+    if columns.get('date') is None or (columns.get('amount') is None and columns.get('debit') is None):
+        raise ValueError('Could not find date and amount columns; pass a column mapping')
+    
+    expenses_negative = mapping.get('expenses_negative', True)
+    date_format = mapping.get('date_format')
+    decimal = mapping.get('decimal', '.')
+    
+    def cell(row, field):
+        index = columns.get(field)
+        return row[index] if index is not None and index < len(row) else None
+    
+    for row in reader:
+        if not row:
+            continue
+        try:
+            day = parse_import_date(cell(row, 'date'), date_format)
+            if columns.get('debit') is not None:
+                amount = parse_import_amount(cell(row, 'debit'), decimal)
+            else:
+                amount = parse_import_amount(cell(row, 'amount'), decimal)
+                if amount is not None:
+                    amount = -amount if expenses_negative else amount
+        except ValueError:
+            day, amount = None, None
+        yield day, amount, (cell(row, 'description') or '').strip(), cell(row, 'category')
+
+def iter_ofx_transactions(f, mapping, progress):
+    buffer = ''
+    while True:
+        chunk = f.read(IMPORT_CHUNK_BYTES)
+        progress['bytes_read'] += len(chunk)
+        buffer += chunk.decode('utf-8', errors='replace')
+        
+        while True:
+            start = buffer.upper().find('<STMTTRN>')
+            end = buffer.upper().find('</STMTTRN>', start)
+            if start < 0 or end < 0:
+                break
+            fields = {tag.upper(): value.strip() for tag, value in
+                      re.findall(r'<(\w+)>([^<\r\n]*)', buffer[start + 9:end])}
+            buffer = buffer[end + 10:]
+            try:
+                amount = -float(fields.get('TRNAMT', ''))
+            except ValueError:
+                amount = None
+            day = parse_import_date(fields.get('DTPOSTED', '')[:8], '%Y%m%d')
+            yield day, amount, fields.get('NAME') or fields.get('MEMO') or '', None
+        
+        if not chunk:
+            break
+        if '<STMTTRN>' not in buffer.upper():
+            buffer = buffer[-16:]
+
+IMPORT_PARSERS = {'csv': iter_csv_transactions, 'ofx': iter_ofx_transactions, 'qfx': iter_ofx_transactions}
+
+def run_import_job(job_id: int, path: str, fmt: str, mapping: Dict):
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    progress = {'bytes_read': 0, 'rows_read': 0, 'inserted': 0, 'duplicates': 0, 'skipped': 0}
+    touched = set()
+    
+    def save_progress(status='running'):
+        c.execute('''UPDATE import_jobs SET status = ?, bytes_read = ?, rows_read = ?, inserted = ?,
+                     duplicates = ?, skipped = ? WHERE id = ?''',
+                  (status, progress['bytes_read'], progress['rows_read'], progress['inserted'],
+                   progress['duplicates'], progress['skipped'], job_id))
+    
+    try:
+        source = expense_source(conn)
+        get_category_classifier()
+        c.execute('SELECT name, id FROM categories')
+        category_ids = {name.lower(): cid for name, cid in c.fetchall()}
+        fallback_id = category_ids.get('other') or next(iter(category_ids.values()))
+        categorize_text = lru_cache(maxsize=4096)(categorize_locally)
+        occurrences = {}
+        
+        with open(path, 'rb') as f:
+            batch = []
+            
+            def flush():
+                archived = set()
+                if batch and source != 'expenses':
+                    c.execute(f"SELECT fingerprint FROM {source} WHERE fingerprint IN ({', '.join('?' for _ in batch)})",
+                              [row[4] for row in batch])
+                    archived = {row[0] for row in c.fetchall()}
+                inserted = []
+                examples = []
+                spent = Counter()
+                for day, amount, description, category_id, fingerprint, labelled in batch:
+                    if fingerprint in archived:
+                        continue
+                    c.execute('''INSERT OR IGNORE INTO expenses
+                                     (amount, category_id, description, date_added, fingerprint, labelled)
+                                 VALUES (?, ?, ?, ?, ?, ?)''',
+                              (amount, category_id, description, f"{day} 00:00:00", fingerprint, labelled))
+                    if c.rowcount:
+                        inserted.append((c.lastrowid, category_id, amount))
+                        spent[day_number(day)] += amount
+                        touched.add(category_id)
+                        if labelled:
+                            examples.append((description, category_id))
+                if inserted:
+                    record_expense_stats_batch(c, inserted)
+                learned = learn_categories(c, examples) if examples else []
+                for day, amount in sorted(spent.items()):
+                    apply_net_worth_delta(c, day, expenses=amount)
+                progress['inserted'] += len(inserted)
+                progress['duplicates'] += len(batch) - len(inserted)
+                save_progress()
+                conn.commit()
+                apply_learned(learned)
+                batch.clear()
+            
+            for day, amount, description, category in IMPORT_PARSERS[fmt](f, mapping, progress):
+                progress['rows_read'] += 1
+                if not day or not amount or amount <= 0:
+                    progress['skipped'] += 1
+                    continue
+                
+                base = (day, round(amount, 2), normalize_description(description))
+                occurrence = occurrences.get(base, 0)
+                occurrences[base] = occurrence + 1
+                
+                labelled = category_ids.get((category or '').strip().lower())
+                category_id = labelled or category_ids.get(categorize_text(classifier_text(description)).lower(), fallback_id)
+                batch.append((day, amount, description, category_id,
+                              transaction_fingerprint(day, amount, description, occurrence), labelled is not None))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush()
+            flush()
+        
+        c.execute('UPDATE import_jobs SET finished_at = CURRENT_TIMESTAMP WHERE id = ?', (job_id,))
+        save_progress('completed')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        c.execute('''UPDATE import_jobs SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP
+                     WHERE id = ?''', (str(e), job_id))
+        conn.commit()
+    finally:
+        for category_id in touched:
+            refresh_alert_levels(c, category_id)
+        conn.close()
+        os.remove(path)
+        recommendation_worker.poke()
+
+@app.route('/api/import', methods=['POST'])
+def start_import():
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify({'error': 'No file uploaded'}), 400
+    
+    filename = upload.filename or 'statement'
+    fmt = (request.form.get('format') or os.path.splitext(filename)[1].lstrip('.') or 'csv').lower()
+    if fmt not in IMPORT_PARSERS:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    try:
+        mapping = json.loads(request.form.get('mapping') or '{}')
+    except ValueError:
+        return jsonify({'error': 'Mapping must be JSON'}), 400
+    
+    fd, path = tempfile.mkstemp(prefix='budget-import-', suffix=f'.{fmt}')
+    with os.fdopen(fd, 'wb') as f:
+        upload.save(f)
+    
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    c.execute('INSERT INTO import_jobs (filename, format, total_bytes) VALUES (?, ?, ?)',
+              (filename, fmt, os.path.getsize(path)))
     conn.commit()
+    job_id = c.lastrowid
     conn.close()
-    return jsonify({'message': 'Expense deleted'}), 200
+    
+    threading.Thread(target=run_import_job, args=(job_id, path, fmt, mapping), daemon=True).start()
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
 
-@app.route('/api/summary', methods=['GET'])
-def get_summary():
-    period = request.args.get('period', 'month')
+@app.route('/api/import/<int:job_id>', methods=['GET'])
+def get_import_job(job_id):
+    conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,))
+    job = c.fetchone()
+    conn.close()
     
+    if not job:
+        return jsonify({'error': 'Import job not found'}), 404
+    job = dict(job)
+    job['progress'] = round(job['bytes_read'] / job['total_bytes'] * 100, 1) if job['total_bytes'] else 100.0
+    return jsonify(job)
+
+def compute_summary(period: str = 'month') -> Dict:
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
@@ -412,11 +2312,12 @@ def get_summary():
     else:
         start_date = '2020-01-01'
     
-    c.execute('''SELECT c.name, SUM(e.amount) as total, c.budget_limit, c.color
-                 FROM expenses e
-                 JOIN categories c ON e.category_id = c.id
-                 WHERE date(e.date_added) >= ?
-                 GROUP BY c.id, c.name, c.budget_limit, c.color''', (start_date,))
+    source = expense_source(conn, start_date)
+    c.execute(f'''SELECT c.name, SUM(e.amount) as total, c.budget_limit, c.color
+                  FROM {source} e
+                  JOIN categories c ON e.category_id = c.id
+                  WHERE date(e.date_added) >= ?
+                  GROUP BY c.id, c.name, c.budget_limit, c.color''', (start_date,))
     
     category_spending = {}
     total_expenses = 0
@@ -439,7 +2340,7 @@ def get_summary():
     
     conn.close()
     
-    return jsonify({
+    return {
         'total_income': total_income,
         'total_expenses': total_expenses,
         'remaining_budget': remaining_budget,
@@ -447,64 +2348,111 @@ def get_summary():
         'category_budgets': category_budgets,
         'top_category': top_category,
         'period': period
-    })
+    }
 
-@app.route('/api/ai/chat', methods=['POST'])
-def ai_chat():
-    data = request.json
-    user_message = data.get('message', '')
-    
-    summary = get_summary().get_json()
+@app.route('/api/summary', methods=['GET'])
+def get_summary():
+    return jsonify(compute_summary(request.args.get('period', 'month')))
+
+# An investment without a current value is counted at what was paid for it, as in net worth.
+INVESTMENT_VALUE = 'COALESCE(current_value, amount, 0)'
+
+def collect_chat_data() -> Dict:
+    summary = compute_summary('month')
     
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
-    c.execute('SELECT SUM(amount) as total FROM income')
-    total_income = c.fetchone()['total'] or 0
-    
-    start_date = datetime.now().replace(day=1).strftime('%Y-%m-%d')
-    c.execute('SELECT SUM(amount) as total FROM expenses WHERE date(date_added) >= ?', (start_date,))
-    total_expenses = c.fetchone()['total'] or 0
-    
-    c.execute('SELECT SUM(current_value) as total FROM investments')
-    total_investments = c.fetchone()['total'] or 0
+    net_worth = net_worth_snapshot(c)['net_worth']
     
-    c.execute('SELECT SUM(current_amount) as total FROM savings_goals')
-    total_savings = c.fetchone()['total'] or 0
+    c.execute('SELECT COUNT(*), COALESCE(SUM(target_amount), 0), COALESCE(SUM(current_amount), 0) FROM savings_goals')
+    goals = dict(zip(('count', 'total', 'saved'), c.fetchone()))
+    c.execute('''SELECT name, target_amount, COALESCE(current_amount, 0), deadline FROM savings_goals
+                 ORDER BY current_amount >= target_amount, deadline IS NULL, deadline, id LIMIT ?''', (PROMPT_TOP_N,))
+    goals['top'] = [tuple(row) for row in c.fetchall()]
     
-    c.execute('SELECT SUM(remaining_amount) as total FROM debts')
-    total_debts = c.fetchone()['total'] or 0
-    
-    c.execute('SELECT * FROM savings_goals')
-    goals = [dict(row) for row in c.fetchall()]
+    c.execute(f'SELECT COUNT(*), COALESCE(SUM({INVESTMENT_VALUE}), 0) FROM investments')
+    investments = dict(zip(('count', 'total'), c.fetchone()))
+    c.execute(f'SELECT name, type, {INVESTMENT_VALUE} as value FROM investments ORDER BY value DESC, id LIMIT ?',
+              (PROMPT_TOP_N,))
+    investments['top'] = [tuple(row) for row in c.fetchall()]
     
-    c.execute('SELECT * FROM investments')
-    investments = [dict(row) for row in c.fetchall()]
-    
-    c.execute('SELECT * FROM debts')
-    debts = [dict(row) for row in c.fetchall()]
+    c.execute('SELECT COUNT(*), COALESCE(SUM(remaining_amount), 0) FROM debts')
+    debts = dict(zip(('count', 'total'), c.fetchone()))
+    c.execute('''SELECT name, COALESCE(remaining_amount, 0), COALESCE(interest_rate, 0) FROM debts
+                 ORDER BY remaining_amount <= 0, interest_rate DESC, remaining_amount DESC, id LIMIT ?''', (PROMPT_TOP_N,))
+    debts['top'] = [tuple(row) for row in c.fetchall()]
     
     conn.close()
     
-    net_worth = total_income - total_expenses + total_investments + total_savings - total_debts
-    
-    user_data = {
+    return {
         'total_income': summary['total_income'],
         'total_expenses': summary['total_expenses'],
         'remaining_budget': summary['remaining_budget'],
         'category_spending': summary['category_spending'],
+        'category_budgets': summary['category_budgets'],
         'top_category': summary['top_category'],
-        'savings_goals': goals,
+        'goals': goals,
         'investments': investments,
         'debts': debts,
         'net_worth': net_worth,
-        'total_investments': total_investments,
-        'total_debts': total_debts
+        'total_investments': investments['total'],
+        'total_debts': debts['total']
     }
+
+def stream_chat_events(user_message: str, user_data: Dict, messages, usage: Dict, api_key):
+    """Yields `delta` events as the reply streams in, then a `done` event with its source and token usage.
+    Falls back to the rule-based reply without an api_key or if the LLM fails before sending anything."""
+    text = ''
+    if api_key:
+        try:
+            stream = get_openai_client(api_key).chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                max_tokens=300,
+                temperature=0.8,
+                stream=True,
+                stream_options={'include_usage': True}
+            )
+            for chunk in stream:
+                if chunk.usage:
+                    usage.update(token_usage(chunk.usage))
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    text += delta
+                    yield format_sse(None, 'delta', {'text': delta})
+        except openai.OpenAIError as e:
+            print(f"OpenAI error: {e}")
     
-    response = get_ai_response(user_message, user_data)
-    return jsonify({'response': response})
+    if not text:
+        yield format_sse(None, 'delta', {'text': get_rule_based_response(user_message, user_data)})
+    yield format_sse(None, 'done', {'source': 'openai' if text else 'rules', 'usage': usage})
+
+@app.route('/api/ai/chat', methods=['POST'])
+def ai_chat():
+    data = request.json
+    user_message = data.get('message', '')
+    user_data = collect_chat_data()
+    
+    messages, usage = build_chat_messages(user_message, user_data)
+    if data.get('stream'):
+        api_key = get_api_key() if OPENAI_AVAILABLE else None
+        admitted = bool(api_key) and admit_llm_call('chat')
+        events = stream_chat_events(user_message, user_data, messages, usage, api_key if admitted else None)
+        response = Response(events, mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        if admitted:
+            started = time.monotonic()
+            response.call_on_close(lambda: admission.release(time.monotonic() - started))
+        return response
+    
+    reply, llm_usage = openai_completion(messages, 300, 0.8, 'chat')
+    if reply is None:
+        return jsonify({'response': get_rule_based_response(user_message, user_data), 'usage': usage,
+                        'source': 'rules'})
+    usage.update(llm_usage or {})
+    return jsonify({'response': reply, 'usage': usage, 'source': 'openai'})
 
 @app.route('/api/goals', methods=['GET'])
 def get_goals():
@@ -524,13 +2472,9 @@ def add_goal():
     deadline = data.get('deadline')
     description = data.get('description', '')
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''INSERT INTO savings_goals (name, target_amount, deadline, description)
-                 VALUES (?, ?, ?, ?)''', (name, target_amount, deadline, description))
-    conn.commit()
-    goal_id = c.lastrowid
-    conn.close()
+    goal_id = write(lambda c: c.execute(
+        '''INSERT INTO savings_goals (name, target_amount, deadline, description) VALUES (?, ?, ?, ?)''',
+        (name, target_amount, deadline, description)).lastrowid)
     
     return jsonify({'id': goal_id, 'name': name, 'target_amount': target_amount, 
                    'current_amount': 0, 'deadline': deadline, 'description': description}), 201
@@ -540,47 +2484,181 @@ def update_goal(goal_id):
     data = request.json
     current_amount = float(data.get('current_amount', 0))
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('UPDATE savings_goals SET current_amount = ? WHERE id = ?', 
-              (current_amount, goal_id))
-    conn.commit()
-    conn.close()
+    def update(c):
+        c.execute('SELECT COALESCE(current_amount, 0) FROM savings_goals WHERE id = ?', (goal_id,))
+        row = c.fetchone()
+        c.execute('UPDATE savings_goals SET current_amount = ? WHERE id = ?', (current_amount, goal_id))
+        if row:
+            apply_net_worth_delta(c, net_worth_today(), savings=current_amount - row[0])
+    
+    write(update)
     return jsonify({'message': 'Goal updated'}), 200
 
 @app.route('/api/goals/<int:goal_id>', methods=['DELETE'])
 def delete_goal(goal_id):
+    def delete(c):
+        c.execute('SELECT COALESCE(current_amount, 0) FROM savings_goals WHERE id = ?', (goal_id,))
+        row = c.fetchone()
+        c.execute('DELETE FROM savings_goals WHERE id = ?', (goal_id,))
+        if row:
+            apply_net_worth_delta(c, net_worth_today(), savings=-row[0])
+    
+    write(delete)
+    return jsonify({'message': 'Goal deleted'}), 200
+
+GOAL_PROJECTION_PATHS = int(os.getenv('GOAL_PROJECTION_PATHS', 5000))
+GOAL_PROJECTION_MAX_PATHS = 10000
+GOAL_PROJECTION_HORIZON = 360
+WEEKS_PER_MONTH = 52 / 12
+RECURRING_INCOME_PERIODS = {'weekly': WEEKS_PER_MONTH, 'monthly': 1}
+
+projection_cache = {'key': None, 'data': None}
+
+def monthly_net_savings(c):
+    """Net savings for each calendar month with activity. Weekly and monthly income are recurring sources that pay
+    every month at today's rate; any other income counts once, in its month. The current month's expenses are
+    pro-rated to a full month."""
+    source = expense_source(c.connection)
+    c.execute(f'''SELECT strftime('%Y-%m', date_added), SUM(amount) FROM {source}
+                  WHERE date_added IS NOT NULL GROUP BY strftime('%Y-%m', date_added)''')
+    expenses = dict(c.fetchall())
+    c.execute('''SELECT strftime('%Y-%m', date_added), period, SUM(amount) FROM income
+                 WHERE date_added IS NOT NULL GROUP BY strftime('%Y-%m', date_added), period''')
+    recurring_income = 0.0
+    one_off_income = {}
+    for month, period, amount in c.fetchall():
+        if period in RECURRING_INCOME_PERIODS:
+            recurring_income += amount * RECURRING_INCOME_PERIODS[period]
+        else:
+            one_off_income[month] = one_off_income.get(month, 0) + amount
+    
+    known = sorted(set(expenses) | set(one_off_income))
+    if not known and not recurring_income:
+        return []
+    
+    now = datetime.now()
+    current = now.strftime('%Y-%m')
+    first = datetime.strptime(min(known[0], current) if known else current, '%Y-%m')
+    months = []
+    offset = 0
+    while add_months(first, offset) <= current:
+        months.append(add_months(first, offset))
+        offset += 1
+    
+    days_in_month = (datetime.strptime(add_months(now, 1) + '-01', '%Y-%m-%d') - timedelta(days=1)).day
+    return [recurring_income + one_off_income.get(month, 0) -
+            expenses.get(month, 0) * (days_in_month / now.day if month == current else 1)
+            for month in months]
+
+def project_goals(goals, history, paths: int, seed: int = 0):
+    """Simulate monthly savings paths and fund goals one after another, earliest deadline first."""
+    today = datetime.now()
+    goals = sorted(goals, key=lambda g: (not g['deadline'], g['deadline'] or '', g['id']))
+    remaining = np.array([max(g['target_amount'] - (g['current_amount'] or 0), 0) for g in goals], dtype=float)
+    thresholds = np.cumsum(remaining)
+    
+    mean = float(np.mean(history)) if history else 0.0
+    std = float(np.std(history, ddof=1)) if len(history) > 1 else 0.0
+    std = max(std, abs(mean) * 0.1)
+    
+    rng = np.random.default_rng(seed)
+    savings = rng.normal(mean, std, size=(paths, GOAL_PROJECTION_HORIZON))
+    reached = np.maximum.accumulate(np.cumsum(savings, axis=1), axis=1)
+    
+    projections = []
+    for goal, need, threshold in zip(goals, remaining, thresholds):
+        deadline_months = None
+        if goal['deadline']:
+            deadline = datetime.strptime(goal['deadline'][:10], '%Y-%m-%d')
+            deadline_months = (deadline.year - today.year) * 12 + deadline.month - today.month
+        
+        if need <= 0:
+            completion = np.zeros(paths, dtype=int)
+        elif std == 0:
+            completion = np.full(paths, GOAL_PROJECTION_HORIZON + 1)
+        else:
+            completion = (reached < threshold).sum(axis=1) + 1
+        
+        completed = completion <= GOAL_PROJECTION_HORIZON
+        probability = None
+        if deadline_months is not None:
+            probability = float((completion <= max(deadline_months, 0)).mean()) if need > 0 else 1.0
+        
+        projection = {
+            'goal_id': goal['id'],
+            'name': goal['name'],
+            'remaining': round(float(need), 2),
+            'deadline': goal['deadline'],
+            'probability': round(probability, 3) if probability is not None else None,
+            'probability_ever': round(float(completed.mean()), 3),
+            'expected_completion': None,
+            'completion_range': None
+        }
+        if completed.any():
+            low, mid, high = np.percentile(completion[completed], [10, 50, 90]).astype(int)
+            projection['expected_completion'] = add_months(today, int(mid)) if need > 0 else today.strftime('%Y-%m')
+            projection['completion_range'] = [add_months(today, int(low)), add_months(today, int(high))]
+        projections.append(projection)
+    
+    return projections, {'months': len(history), 'mean': round(mean, 2), 'std': round(std, 2)}
+
+@app.route('/api/goals/projections', methods=['GET'])
+def get_goal_projections():
+    try:
+        paths = int(request.args.get('paths', GOAL_PROJECTION_PATHS))
+    except ValueError:
+        return jsonify({'error': 'paths must be an integer'}), 400
+    paths = min(max(paths, 100), GOAL_PROJECTION_MAX_PATHS)
+    
     conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
     c = conn.cursor()
-    c.execute('DELETE FROM savings_goals WHERE id = ?', (goal_id,))
-    conn.commit()
+    
+    key = (get_data_versions(c, 'income', 'expenses', 'savings_goals'), paths, datetime.now().strftime('%Y-%m-%d'))
+    if projection_cache['key'] == key:
+        conn.close()
+        return jsonify(projection_cache['data'])
+    
+    c.execute('SELECT id, name, target_amount, current_amount, deadline FROM savings_goals ORDER BY id')
+    goals = [dict(row) for row in c.fetchall()]
+    history = monthly_net_savings(c)
     conn.close()
-    return jsonify({'message': 'Goal deleted'}), 200
+    
+    projections, stats = project_goals(goals, history, paths) if goals else ([], None)
+    data = {
+        'projections': projections,
+        'history': stats,
+        'paths': paths,
+        'computed_at': datetime.now().isoformat(timespec='seconds')
+    }
+    projection_cache.update(key=key, data=data)
+    return jsonify(data)
 
 @app.route('/api/trends', methods=['GET'])
 def get_trends():
     period = request.args.get('period', 'month')
     days = 30 if period == 'month' else 7
     
-    conn = sqlite3.connect(DATABASE)
+    conn = analytics_connect()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
     start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
-    c.execute('''SELECT date(date_added) as date, SUM(amount) as total
-                 FROM expenses
-                 WHERE date(date_added) >= ?
-                 GROUP BY date(date_added)
-                 ORDER BY date(date_added)''', (start_date,))
+    source = expense_source(conn, start_date)
+    c.execute(f'''SELECT date(date_added) as date, SUM(amount) as total
+                  FROM {source}
+                  WHERE date(date_added) >= ?
+                  GROUP BY date(date_added)
+                  ORDER BY date(date_added)''', (start_date,))
     
     daily_totals = [{'date': row['date'], 'amount': row['total']} for row in c.fetchall()]
     
-    c.execute('''SELECT c.name, SUM(e.amount) as total, COUNT(e.id) as count
-                 FROM expenses e
-                 JOIN categories c ON e.category_id = c.id
-                 WHERE date(e.date_added) >= ?
-                 GROUP BY c.id, c.name
-                 ORDER BY total DESC''', (start_date,))
+    c.execute(f'''SELECT c.name, SUM(e.amount) as total, COUNT(e.id) as count
+                  FROM {source} e
+                  JOIN categories c ON e.category_id = c.id
+                  WHERE date(e.date_added) >= ?
+                  GROUP BY c.id, c.name
+                  ORDER BY total DESC''', (start_date,))
     
     category_trends = [{'name': row['name'], 'total': row['total'], 'count': row['count']} 
                        for row in c.fetchall()]
@@ -593,8 +2671,31 @@ def get_trends():
         'period': period
     })
 
-@app.route('/api/alerts', methods=['GET'])
-def get_alerts():
+ALERT_HEARTBEAT_SECONDS = 15
+ALERT_EVENT_BUFFER = 256
+
+def budget_alert(name: str, budget_limit, spent: float):
+    budget_limit = budget_limit or 0
+    if budget_limit <= 0:
+        return None
+    percentage = (spent / budget_limit) * 100
+    if percentage >= 100:
+        return {
+            'type': 'over_budget',
+            'category': name,
+            'message': f"You've exceeded your {name} budget by ${spent - budget_limit:.2f}",
+            'severity': 'high'
+        }
+    if percentage >= 80:
+        return {
+            'type': 'warning',
+            'category': name,
+            'message': f"You've used {percentage:.0f}% of your {name} budget",
+            'severity': 'medium'
+        }
+    return None
+
+def collect_alerts():
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
@@ -607,37 +2708,163 @@ def get_alerts():
     
     alerts = []
     for row in c.fetchall():
-        budget_limit = row['budget_limit'] or 0
-        spent = row['spent']
-        if budget_limit > 0:
-            percentage = (spent / budget_limit) * 100
-            if percentage >= 100:
-                alerts.append({
-                    'type': 'over_budget',
-                    'category': row['name'],
-                    'message': f"You've exceeded your {row['name']} budget by ${spent - budget_limit:.2f}",
-                    'severity': 'high'
-                })
-            elif percentage >= 80:
-                alerts.append({
-                    'type': 'warning',
-                    'category': row['name'],
-                    'message': f"You've used {percentage:.0f}% of your {row['name']} budget",
-                    'severity': 'medium'
-                })
+        alert = budget_alert(row['name'], row['budget_limit'], row['spent'])
+        if alert:
+            alerts.append(alert)
+    
+    c.execute('''SELECT a.expense_id, a.amount, a.mean, c.name, e.description
+                 FROM expense_anomalies a
+                 JOIN expenses e ON e.id = a.expense_id
+                 JOIN categories c ON c.id = a.category_id
+                 WHERE date(e.date_added) >= ?
+                 ORDER BY e.date_added DESC''', (start_date,))
+    for row in c.fetchall():
+        alerts.append(anomaly_alert(row['expense_id'], row['name'], row['description'], row['amount'], row['mean']))
     
     conn.close()
-    return jsonify(alerts)
+    return alerts
+
+def anomaly_alert(expense_id: int, name: str, description: str, amount: float, mean: float):
+    label = f" ({description})" if description else ''
+    return {
+        'type': 'unusual_expense',
+        'category': name,
+        'expense_id': expense_id,
+        'message': f"Unusual {name} expense{label}: ${amount:.2f} vs your usual ${mean:.2f}",
+        'severity': 'medium'
+    }
+
+class AlertBus:
+    """In-process fan-out of alert changes to SSE subscribers, with a replay buffer for Last-Event-ID."""
+    
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=ALERT_EVENT_BUFFER)
+        self.last_id = int(time.time() * 1000)
+        self.levels = None
+        self.month = None
+        self.listeners = set()
+    
+    def publish(self, event: str, data):
+        with self.condition:
+            self.last_id += 1
+            self.events.append((self.last_id, event, data))
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+    
+    def since(self, last_id: int):
+        with self.condition:
+            if self.events and last_id < self.events[0][0] - 1:
+                return None
+            if last_id > self.last_id:
+                return None
+            return [e for e in self.events if e[0] > last_id]
+    
+    def wait(self, last_id: int, timeout: float):
+        with self.condition:
+            pending = self.since(last_id)
+            if pending == []:
+                self.condition.wait(timeout)
+                pending = self.since(last_id)
+            return pending
+
+alert_bus = AlertBus()
+
+def category_alert_level(alert):
+    return alert['type'] if alert else None
+
+def refresh_alert_levels(c=None, category_id=None):
+    month = datetime.now().strftime('%Y-%m')
+    if alert_bus.levels is not None and alert_bus.month != month:
+        category_id = None
+    
+    own_conn = c is None
+    if own_conn:
+        conn = sqlite3.connect(DATABASE)
+        c = conn.cursor()
+    
+    start_date = f"{month}-01"
+    query = '''SELECT c.id, c.name, c.budget_limit, COALESCE(SUM(e.amount), 0)
+               FROM categories c
+               LEFT JOIN expenses e ON c.id = e.category_id AND date(e.date_added) >= ?'''
+    if category_id is not None and alert_bus.levels is not None:
+        c.execute(query + ' WHERE c.id = ? GROUP BY c.id', (start_date, category_id))
+    else:
+        c.execute(query + ' GROUP BY c.id', (start_date,))
+    rows = c.fetchall()
+    
+    if own_conn:
+        conn.close()
+    
+    with alert_bus.condition:
+        primed = alert_bus.levels is not None
+        if not primed:
+            alert_bus.levels = {}
+        alert_bus.month = month
+        changes = []
+        for cid, name, budget_limit, spent in rows:
+            alert = budget_alert(name, budget_limit, spent)
+            level = category_alert_level(alert)
+            if primed and alert_bus.levels.get(cid) != level:
+                changes.append({'category_id': cid, 'category': name, 'level': level, 'alert': alert})
+            alert_bus.levels[cid] = level
+    
+    for change in changes:
+        alert_bus.publish('alert', change)
+
+def format_sse(event_id, event: str, data) -> str:
+    id_line = f"id: {event_id}\n" if event_id is not None else ''
+    return f"{id_line}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/alerts', methods=['GET'])
+def get_alerts():
+    return jsonify(collect_alerts())
+
+@app.route('/api/alerts/stream', methods=['GET'])
+def stream_alerts():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_id = None
+    
+    if alert_bus.levels is None:
+        refresh_alert_levels()
+    
+    def generate(last_id):
+        yield "retry: 3000\n\n"
+        if last_id is None or alert_bus.since(last_id) is None:
+            last_id = alert_bus.last_id
+            yield format_sse(last_id, 'snapshot', collect_alerts())
+        
+        while True:
+            pending = alert_bus.wait(last_id, ALERT_HEARTBEAT_SECONDS)
+            if pending is None:
+                last_id = alert_bus.last_id
+                yield format_sse(last_id, 'snapshot', collect_alerts())
+            elif not pending:
+                if alert_bus.month != datetime.now().strftime('%Y-%m'):
+                    refresh_alert_levels()
+                yield ": heartbeat\n\n"
+            else:
+                for event_id, event, data in pending:
+                    last_id = event_id
+                    yield format_sse(event_id, event, data)
+    
+    return Response(generate(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/investments', methods=['GET'])
 def get_investments():
+    fmt = table_format()
     conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute('SELECT * FROM investments ORDER BY created_at DESC')
-    investments = [dict(row) for row in c.fetchall()]
+    investments = fetch_table(c, fmt)
     conn.close()
-    return jsonify(investments)
+    return table_response(investments, fmt)
 
 @app.route('/api/investments', methods=['POST'])
 def add_investment():
@@ -649,14 +2876,17 @@ def add_investment():
     current_value = float(data.get('current_value', amount))
     notes = data.get('notes', '')
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''INSERT INTO investments (name, type, amount, purchase_date, current_value, notes)
-                 VALUES (?, ?, ?, ?, ?, ?)''',
-              (name, investment_type, amount, purchase_date, current_value, notes))
-    conn.commit()
-    investment_id = c.lastrowid
-    conn.close()
+    def insert(c):
+        c.execute('''INSERT INTO investments (name, type, amount, purchase_date, current_value, notes)
+                     VALUES (?, ?, ?, ?, ?, ?)''',
+                  (name, investment_type, amount, purchase_date, current_value, notes))
+        investment_id = c.lastrowid
+        if purchase_date and day_number(purchase_date) < day_number():
+            record_investment_value(c, investment_id, day_number(purchase_date), amount)
+        record_investment_value(c, investment_id, day_number(), current_value)
+        return investment_id
+    
+    investment_id = write(insert)
     
     return jsonify({'id': investment_id, 'name': name, 'type': investment_type,
                    'amount': amount, 'current_value': current_value}), 201
@@ -666,32 +2896,99 @@ def update_investment(investment_id):
     data = request.json
     current_value = float(data.get('current_value', 0))
     
+    def update(c):
+        c.execute('UPDATE investments SET current_value = ? WHERE id = ?',
+                  (current_value, investment_id))
+        if c.rowcount:
+            record_investment_value(c, investment_id, day_number(), current_value)
+    
+    write(update)
+    return jsonify({'message': 'Investment updated'}), 200
+
+@app.route('/api/investments/values', methods=['PUT'])
+def update_investment_values():
+    data = request.json or {}
+    default_date = data.get('date')
+    entries = data.get('values', [])
+    if isinstance(entries, dict):
+        entries = [{'id': key, 'value': value} for key, value in entries.items()]
+    
+    try:
+        values = [(int(entry['id']), day_number(entry.get('date') or default_date), float(entry['value']))
+                  for entry in entries]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Each value needs an id, a numeric value and an optional YYYY-MM-DD date'}), 400
+    
+    def update(c):
+        c.execute('SELECT id FROM investments')
+        known = {row[0] for row in c.fetchall()}
+        accepted = [v for v in values if v[0] in known]
+        unknown = sorted({v[0] for v in values if v[0] not in known})
+        
+        if accepted:
+            record_investment_values(c, accepted)
+        c.executemany('''UPDATE investments
+                         SET current_value = (SELECT value FROM investment_values
+                                              WHERE investment_id = ? ORDER BY day DESC LIMIT 1)
+                         WHERE id = ?''', [(i, i) for i in {v[0] for v in accepted}])
+        return accepted, unknown
+    
+    accepted, unknown = write(update)
+    
+    return jsonify({'updated': len(accepted), 'unknown_ids': unknown}), 200
+
+@app.route('/api/investments/<int:investment_id>/history', methods=['GET'])
+def get_investment_history(investment_id):
+    points = min(max(int(request.args.get('points', 200)), 3), 5000)
+    start = day_number(request.args['from']) if request.args.get('from') else 0
+    end = day_number(request.args['to']) if request.args.get('to') else day_number() + 36500
+    
     conn = sqlite3.connect(DATABASE)
     c = conn.cursor()
-    c.execute('UPDATE investments SET current_value = ? WHERE id = ?',
-              (current_value, investment_id))
-    conn.commit()
+    c.execute('SELECT name, amount FROM investments WHERE id = ?', (investment_id,))
+    investment = c.fetchone()
+    if not investment:
+        conn.close()
+        return jsonify({'error': 'Investment not found'}), 404
+    
+    c.execute('''SELECT day, value FROM investment_values
+                 WHERE investment_id = ? AND day BETWEEN ? AND ?
+                 ORDER BY day''', (investment_id, start, end))
+    rows = c.fetchall()
     conn.close()
-    return jsonify({'message': 'Investment updated'}), 200
+    
+    days = [row[0] for row in rows]
+    values = [row[1] for row in rows]
+    keep = downsample_lttb(days, values, points)
+    
+    return jsonify({
+        'id': investment_id,
+        'name': investment[0],
+        'amount': investment[1],
+        'total_points': len(rows),
+        'history': [{'date': day_string(days[i]), 'value': values[i]} for i in keep]
+    })
 
 @app.route('/api/investments/<int:investment_id>', methods=['DELETE'])
 def delete_investment(investment_id):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('DELETE FROM investments WHERE id = ?', (investment_id,))
-    conn.commit()
-    conn.close()
+    def delete(c):
+        c.execute('SELECT day, value FROM investment_values WHERE investment_id = ? ORDER BY day', (investment_id,))
+        apply_investment_steps(c, value_steps(c.fetchall(), -1))
+        c.execute('DELETE FROM investments WHERE id = ?', (investment_id,))
+        c.execute('DELETE FROM investment_values WHERE investment_id = ?', (investment_id,))
+    
+    write(delete)
     return jsonify({'message': 'Investment deleted'}), 200
 
 @app.route('/api/debts', methods=['GET'])
 def get_debts():
+    fmt = table_format()
     conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute('SELECT * FROM debts ORDER BY created_at DESC')
-    debts = [dict(row) for row in c.fetchall()]
+    debts = fetch_table(c, fmt)
     conn.close()
-    return jsonify(debts)
+    return table_response(debts, fmt)
 
 @app.route('/api/debts', methods=['POST'])
 def add_debt():
@@ -703,14 +3000,15 @@ def add_debt():
     due_date = data.get('due_date')
     description = data.get('description', '')
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''INSERT INTO debts (name, total_amount, remaining_amount, interest_rate, due_date, description)
-                 VALUES (?, ?, ?, ?, ?, ?)''',
-              (name, total_amount, remaining_amount, interest_rate, due_date, description))
-    conn.commit()
-    debt_id = c.lastrowid
-    conn.close()
+    def insert(c):
+        c.execute('''INSERT INTO debts (name, total_amount, remaining_amount, interest_rate, due_date, description)
+                     VALUES (?, ?, ?, ?, ?, ?)''',
+                  (name, total_amount, remaining_amount, interest_rate, due_date, description))
+        debt_id = c.lastrowid
+        apply_net_worth_delta(c, net_worth_today(), debts=remaining_amount)
+        return debt_id
+    
+    debt_id = write(insert)
     
     return jsonify({'id': debt_id, 'name': name, 'total_amount': total_amount,
                    'remaining_amount': remaining_amount}), 201
@@ -720,22 +3018,182 @@ def update_debt(debt_id):
     data = request.json
     remaining_amount = float(data.get('remaining_amount', 0))
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('UPDATE debts SET remaining_amount = ? WHERE id = ?',
-              (remaining_amount, debt_id))
-    conn.commit()
-    conn.close()
+    def update(c):
+        c.execute('SELECT remaining_amount FROM debts WHERE id = ?', (debt_id,))
+        row = c.fetchone()
+        c.execute('UPDATE debts SET remaining_amount = ? WHERE id = ?', (remaining_amount, debt_id))
+        if row:
+            apply_net_worth_delta(c, net_worth_today(), debts=remaining_amount - row[0])
+    
+    write(update)
     return jsonify({'message': 'Debt updated'}), 200
 
 @app.route('/api/debts/<int:debt_id>', methods=['DELETE'])
 def delete_debt(debt_id):
+    def delete(c):
+        c.execute('SELECT remaining_amount FROM debts WHERE id = ?', (debt_id,))
+        row = c.fetchone()
+        c.execute('DELETE FROM debts WHERE id = ?', (debt_id,))
+        if row:
+            apply_net_worth_delta(c, net_worth_today(), debts=-row[0])
+    
+    write(delete)
+    return jsonify({'message': 'Debt deleted'}), 200
+
+DEBT_PLAN_STRATEGIES = ('avalanche', 'snowball', 'custom', 'minimum')
+DEBT_PLAN_MAX_MONTHS = 600
+
+def simulate_debt_payoff(balances, rates, minimums, orders, extras, rollover, horizon: int, detail: bool = False):
+    """Amortize every debt month by month for all scenarios at once.
+    
+    balances, rates and minimums have one entry per debt; orders is a (scenarios, debts) array of
+    payment priorities, extras and rollover have one entry per scenario.
+    """
+    scenarios, count = orders.shape
+    rows = np.arange(scenarios)[:, None]
+    balance = np.tile(balances, (scenarios, 1))
+    monthly_rate = rates / 1200
+    budget = minimums.sum() + extras
+    
+    payoff_month = np.full((scenarios, count), -1)
+    payoff_month[balance <= 0] = 0
+    debt_interest = np.zeros((scenarios, count))
+    totals = np.zeros((horizon, 3, scenarios))
+    payments = np.zeros((horizon, scenarios, count)) if detail else None
+    
+    months = 0
+    for month in range(horizon):
+        active = balance > 0
+        if not active.any():
+            break
+        months = month + 1
+        
+        interest = balance * monthly_rate
+        balance = balance + interest
+        minimum = np.minimum(balance, minimums)
+        leftover = np.where(rollover, budget - minimum.sum(axis=1), extras)
+        
+        remaining = (balance - minimum)[rows, orders]
+        ahead = np.cumsum(remaining, axis=1) - remaining
+        extra = np.clip(leftover[:, None] - ahead, 0, remaining)
+        
+        payment = minimum
+        payment[rows, orders] += extra
+        balance = balance - payment
+        balance[balance < 0.005] = 0
+        
+        payoff_month[active & (balance == 0)] = months
+        debt_interest += interest
+        totals[month] = payment.sum(axis=1), interest.sum(axis=1), balance.sum(axis=1)
+        if detail:
+            payments[month] = payment
+    
+    return {
+        'payoff_month': payoff_month,
+        'debt_interest': debt_interest,
+        'totals': totals[:months],
+        'payments': payments[:months] if detail else None
+    }
+
+@app.route('/api/debts/plan', methods=['GET'])
+def get_debt_plan():
+    strategies = request.args.get('strategies', 'avalanche,snowball,minimum').split(',')
+    unknown = [s for s in strategies if s not in DEBT_PLAN_STRATEGIES]
+    if unknown:
+        return jsonify({'error': f"Unknown strategy: {', '.join(unknown)}"}), 400
+    
+    try:
+        extras = [float(x) for x in request.args.get('extra', '0').split(',')]
+        horizon = min(int(request.args.get('months', 360)), DEBT_PLAN_MAX_MONTHS)
+        min_payment_pct = float(request.args.get('min_payment_pct', 1)) / 100
+        min_payment_floor = float(request.args.get('min_payment', 25))
+        custom_order = [int(x) for x in request.args.get('order', '').split(',') if x]
+    except ValueError:
+        return jsonify({'error': 'Invalid plan parameters'}), 400
+    detail = request.args.get('detail', 'false').lower() in ('1', 'true')
+    
+    if 'custom' in strategies and not custom_order:
+        return jsonify({'error': 'Custom strategy needs an order of debt ids'}), 400
+    
     conn = sqlite3.connect(DATABASE)
     c = conn.cursor()
-    c.execute('DELETE FROM debts WHERE id = ?', (debt_id,))
-    conn.commit()
+    c.execute('SELECT id, name, remaining_amount, COALESCE(interest_rate, 0) FROM debts WHERE remaining_amount > 0 ORDER BY id')
+    debts = c.fetchall()
     conn.close()
-    return jsonify({'message': 'Debt deleted'}), 200
+    
+    if not debts:
+        return jsonify({'debts': [], 'plans': []})
+    
+    ids = np.array([d[0] for d in debts])
+    balances = np.array([d[2] for d in debts], dtype=float)
+    rates = np.array([d[3] for d in debts], dtype=float)
+    minimums = np.maximum(balances * (rates / 1200 + min_payment_pct), min_payment_floor)
+    
+    avalanche = np.lexsort((balances, -rates))
+    snowball = np.lexsort((-rates, balances))
+    position = {debt_id: i for i, debt_id in enumerate(ids.tolist())}
+    custom = [position[d] for d in custom_order if d in position]
+    custom += [i for i in avalanche.tolist() if i not in custom]
+    priority = {'avalanche': avalanche, 'snowball': snowball, 'custom': np.array(custom), 'minimum': avalanche}
+    
+    scenarios = [(strategy, 0.0 if strategy == 'minimum' else extra)
+                 for strategy in strategies
+                 for extra in (extras if strategy != 'minimum' else [0.0])]
+    orders = np.array([priority[strategy] for strategy, _ in scenarios])
+    extra_payments = np.array([extra for _, extra in scenarios])
+    rollover = np.array([strategy != 'minimum' for strategy, _ in scenarios])
+    
+    result = simulate_debt_payoff(balances, rates, minimums, orders, extra_payments, rollover, horizon, detail)
+    
+    start = datetime.now()
+    totals = result['totals']
+    baseline_interest = None
+    if 'minimum' in strategies:
+        baseline_interest = float(totals[:, 1, [s for s, _ in scenarios].index('minimum')].sum())
+    
+    plans = []
+    for i, (strategy, extra) in enumerate(scenarios):
+        payoff_month = result['payoff_month'][i]
+        paid_off = bool((payoff_month >= 0).all())
+        months = int(payoff_month.max()) if paid_off else None
+        span = months if paid_off else len(totals)
+        total_interest = float(totals[:span, 1, i].sum())
+        
+        plan = {
+            'strategy': strategy,
+            'extra_payment': extra,
+            'monthly_budget': round(float(minimums.sum() + (0 if strategy == 'minimum' else extra)), 2),
+            'months': months,
+            'payoff_date': add_months(start, months) if paid_off else None,
+            'total_interest': round(total_interest, 2),
+            'total_paid': round(float(totals[:span, 0, i].sum()), 2),
+            'interest_saved': round(baseline_interest - total_interest, 2) if baseline_interest is not None else None,
+            'debts': [{
+                'id': int(ids[d]),
+                'payoff_month': int(payoff_month[d]) if payoff_month[d] >= 0 else None,
+                'payoff_date': add_months(start, int(payoff_month[d])) if payoff_month[d] >= 0 else None,
+                'interest': round(float(result['debt_interest'][i, d]), 2)
+            } for d in range(len(ids))],
+            'schedule': [{
+                'month': m + 1,
+                'date': add_months(start, m + 1),
+                'payment': round(float(totals[m, 0, i]), 2),
+                'interest': round(float(totals[m, 1, i]), 2),
+                'balance': round(float(totals[m, 2, i]), 2)
+            } for m in range(span)]
+        }
+        if detail:
+            for m, entry in enumerate(plan['schedule']):
+                entry['payments'] = {int(ids[d]): round(float(result['payments'][m, i, d]), 2)
+                                     for d in range(len(ids)) if result['payments'][m, i, d] > 0}
+        plans.append(plan)
+    
+    return jsonify({
+        'debts': [{'id': int(ids[d]), 'name': debts[d][1], 'remaining_amount': float(balances[d]),
+                   'interest_rate': float(rates[d]), 'minimum_payment': round(float(minimums[d]), 2)}
+                  for d in range(len(ids))],
+        'plans': plans
+    })
 
 @app.route('/api/recurring', methods=['GET'])
 def get_recurring():
@@ -760,142 +3218,110 @@ def add_recurring():
     frequency = data.get('frequency', 'monthly')
     next_due_date = data.get('next_due_date')
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''INSERT INTO recurring_expenses (name, amount, category_id, frequency, next_due_date)
-                 VALUES (?, ?, ?, ?, ?)''',
-              (name, amount, category_id, frequency, next_due_date))
-    conn.commit()
-    recurring_id = c.lastrowid
-    conn.close()
+    recurring_id = write(lambda c: c.execute(
+        '''INSERT INTO recurring_expenses (name, amount, category_id, frequency, next_due_date)
+           VALUES (?, ?, ?, ?, ?)''',
+        (name, amount, category_id, frequency, next_due_date)).lastrowid)
     
     return jsonify({'id': recurring_id, 'name': name, 'amount': amount}), 201
 
 @app.route('/api/recurring/<int:recurring_id>', methods=['DELETE'])
 def delete_recurring(recurring_id):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('UPDATE recurring_expenses SET is_active = 0 WHERE id = ?', (recurring_id,))
-    conn.commit()
-    conn.close()
+    write(lambda c: c.execute('UPDATE recurring_expenses SET is_active = 0 WHERE id = ?', (recurring_id,)))
     return jsonify({'message': 'Recurring expense deleted'}), 200
 
 @app.route('/api/overview', methods=['GET'])
 def get_overview():
     conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
+    snapshot = net_worth_snapshot(c)
+    conn.close()
     
-    c.execute('SELECT SUM(amount) as total FROM income')
-    total_income = c.fetchone()['total'] or 0
-    
-    start_date = datetime.now().replace(day=1).strftime('%Y-%m-%d')
-    c.execute('SELECT SUM(amount) as total FROM expenses WHERE date(date_added) >= ?', (start_date,))
-    total_expenses = c.fetchone()['total'] or 0
-    
-    c.execute('SELECT SUM(current_value) as total FROM investments')
-    total_investments = c.fetchone()['total'] or 0
-    
-    c.execute('SELECT SUM(current_amount) as total FROM savings_goals')
-    total_savings = c.fetchone()['total'] or 0
-    
-    c.execute('SELECT SUM(remaining_amount) as total FROM debts')
-    total_debts = c.fetchone()['total'] or 0
-    
-    net_worth = total_income - total_expenses + total_investments + total_savings - total_debts
+    return jsonify({
+        'total_income': snapshot['income'],
+        'total_expenses': snapshot['expenses'],
+        'total_investments': snapshot['investments'],
+        'total_savings': snapshot['savings'],
+        'total_debts': snapshot['debts'],
+        'net_worth': snapshot['net_worth'],
+        'available_cash': round(snapshot['income'] - snapshot['expenses'], 2)
+    })
+
+@app.route('/api/overview/history', methods=['GET'])
+def get_overview_history():
+    points = min(max(int(request.args.get('points', 200)), 3), 5000)
+    start = day_number(request.args['from']) if request.args.get('from') else 0
+    end = day_number(request.args['to']) if request.args.get('to') else net_worth_today()
     
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    c.execute('SELECT * FROM net_worth_daily WHERE day BETWEEN ? AND ? ORDER BY day', (start, end))
+    rows = c.fetchall()
+    
+    # Days since the last write have no row yet; carry the last one forward to today.
+    last_day = rows[-1][0] if rows else start - 1
+    if last_day < min(end, net_worth_today()):
+        c.execute('SELECT * FROM net_worth_daily WHERE day <= ? ORDER BY day DESC LIMIT 1', (end,))
+        last = c.fetchone()
+        if last:
+            rows.extend(row for row in carry_net_worth(last, min(end, net_worth_today())) if row[0] >= start)
     conn.close()
     
+    days = [row[0] for row in rows]
+    keep = downsample_lttb(days, [row[6] for row in rows], points)
+    
     return jsonify({
-        'total_income': total_income,
-        'total_expenses': total_expenses,
-        'total_investments': total_investments,
-        'total_savings': total_savings,
-        'total_debts': total_debts,
-        'net_worth': net_worth,
-        'available_cash': total_income - total_expenses
+        'total_points': len(rows),
+        'history': [dict(zip(('date',) + NET_WORTH_COLUMNS, (day_string(days[i]),) + tuple(rows[i][1:])))
+                    for i in keep]
     })
 
+def build_categorize_prompt(description: str, amount) -> str:
+    return f"""Categorize this expense: "{description}" for ${amount}. 
+            Return ONLY the category name from this list: Food, Transport, Fun, Shopping, Other.
+            Return just the category name, nothing else."""
+
 @app.route('/api/ai/categorize', methods=['POST'])
 def ai_categorize_expense():
     data = request.json
     description = data.get('description', '')
     amount = data.get('amount', 0)
     
-    api_key = get_api_key()
+    category, confidence, source = classify_locally(description)
+    if source == 'model' and confidence >= CLASSIFIER_MIN_CONFIDENCE:
+        return jsonify({'category': category, 'confidence': confidence, 'source': source})
     
-    if api_key and OPENAI_AVAILABLE:
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=api_key)
-            
-            prompt = f"""Categorize this expense: "{description}" for ${amount}. 
-            Return ONLY the category name from this list: Food, Transport, Fun, Shopping, Other.
-            Return just the category name, nothing else."""
-            
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=10,
-                temperature=0.3
-            )
-            category = response.choices[0].message.content.strip()
-            return jsonify({'category': category})
-        except:
-            pass
+    prompt = build_categorize_prompt(description, amount)
+    reply, _ = openai_completion([{"role": "user", "content": prompt}], 10, 0.3, 'categorize')
+    if reply:
+        return jsonify({'category': reply, 'confidence': None, 'source': 'openai'})
     
-    desc_lower = description.lower()
-    if any(word in desc_lower for word in ['food', 'restaurant', 'grocery', 'eat', 'meal', 'cafe', 'pizza', 'burger']):
-        return jsonify({'category': 'Food'})
-    elif any(word in desc_lower for word in ['uber', 'taxi', 'bus', 'train', 'gas', 'fuel', 'parking', 'transport']):
-        return jsonify({'category': 'Transport'})
-    elif any(word in desc_lower for word in ['movie', 'game', 'entertainment', 'fun', 'party', 'concert']):
-        return jsonify({'category': 'Fun'})
-    elif any(word in desc_lower for word in ['shop', 'store', 'buy', 'purchase', 'amazon', 'clothes']):
-        return jsonify({'category': 'Shopping'})
-    else:
-        return jsonify({'category': 'Other'})
+    return jsonify({'category': category, 'confidence': confidence, 'source': source})
 
-@app.route('/api/ai/budget-recommendations', methods=['GET'])
-def ai_budget_recommendations():
-    summary = get_summary().get_json()
+def collect_recommendation_data():
+    summary = compute_summary('month')
     
     conn = sqlite3.connect(DATABASE)
     c = conn.cursor()
     c.execute('SELECT SUM(remaining_amount) as total FROM debts')
     total_debts = c.fetchone()[0] or 0
+    net_worth = net_worth_snapshot(c)['net_worth']
     conn.close()
     
-    overview = {'total_debts': total_debts}
-    
-    api_key = get_api_key()
-    
-    if api_key and OPENAI_AVAILABLE:
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=api_key)
-            
-            prompt = f"""Based on this financial data:
+    return summary, {'total_debts': total_debts, 'net_worth': round(net_worth, 2)}
+
+def build_recommendations_prompt(summary: Dict, overview: Dict) -> str:
+    return f"""Based on this financial data:
             Income: ${summary['total_income']}
             Expenses: ${summary['total_expenses']}
             Category Spending: {json.dumps(summary['category_spending'])}
             Net Worth: ${overview.get('net_worth', 0)}
             
             Provide 3 specific budget recommendations. Format as JSON array with objects containing 'title' and 'description' fields."""
-            
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=200,
-                temperature=0.7
-            )
-            recommendations = json.loads(response.choices[0].message.content.strip())
-            return jsonify(recommendations)
-        except:
-            pass
-    
+
+def get_rule_based_recommendations(summary: Dict, overview: Dict):
     recommendations = []
-    if summary['total_expenses'] > summary['total_income'] * 0.8:
+    if summary['total_income'] > 0 and summary['total_expenses'] > summary['total_income'] * 0.8:
         recommendations.append({
             'title': 'Reduce Spending',
             'description': f"You're spending {((summary['total_expenses']/summary['total_income'])*100):.1f}% of your income. Try to reduce expenses by 10-20%."
@@ -914,64 +3340,222 @@ def ai_budget_recommendations():
             'description': f'You have ${overview["total_debts"]:.2f} in debt. Focus on paying high-interest debt first.'
         })
     
-    return jsonify(recommendations)
+    return recommendations
 
-@app.route('/api/ai/predict-expenses', methods=['GET'])
-def ai_predict_expenses():
-    period = request.args.get('period', 'month')
-    days = 30 if period == 'month' else 7
+RECOMMENDATION_TABLES = ('income', 'expenses', 'debts', 'categories')
+RECOMMENDATION_EXPENSE_DELTA = float(os.getenv('RECOMMENDATION_EXPENSE_DELTA', 50))
+RECOMMENDATION_RELATIVE_DELTA = 0.1
+RECOMMENDATION_HISTORY = 20
+RECOMMENDATION_RETRY_SECONDS = float(os.getenv('RECOMMENDATION_RETRY_SECONDS', 60))
+RECOMMENDATION_RETRY_MAX = 3600
+
+# When the LLM call falls back to rules, the next attempt waits twice as long as the last, up to the maximum.
+recommendation_retry = {'failures': 0, 'at': None}
+
+def schedule_recommendation_retry(source: str):
+    if source == 'rules' and get_api_key():
+        recommendation_retry['failures'] += 1
+        delay = RECOMMENDATION_RETRY_SECONDS * 2 ** (recommendation_retry['failures'] - 1)
+        recommendation_retry['at'] = time.time() + min(delay, RECOMMENDATION_RETRY_MAX)
+    else:
+        recommendation_retry.update(failures=0, at=None)
+
+def recommendation_retry_due() -> bool:
+    return recommendation_retry['at'] is not None and time.time() >= recommendation_retry['at']
+
+def generate_recommendations(summary: Dict, overview: Dict):
+    prompt = build_recommendations_prompt(summary, overview)
+    reply, _ = openai_completion([{"role": "user", "content": prompt}], 200, 0.7, 'recommendations')
+    if reply:
+        try:
+            return json.loads(reply), 'openai'
+        except ValueError:
+            pass
+    
+    return get_rule_based_recommendations(summary, overview), 'rules'
+
+def recommendation_fingerprint(c, summary: Dict, overview: Dict) -> Dict:
+    c.execute('SELECT COUNT(*) FROM debts')
+    return {
+        'total_income': summary['total_income'],
+        'total_expenses': summary['total_expenses'],
+        'total_debts': overview['total_debts'],
+        'debt_count': c.fetchone()[0],
+        'top_category': summary['top_category']
+    }
+
+def meaningful_change(old: Dict, new: Dict) -> bool:
+    expense_delta = abs(new['total_expenses'] - old['total_expenses'])
+    if expense_delta >= max(RECOMMENDATION_EXPENSE_DELTA, old['total_expenses'] * RECOMMENDATION_RELATIVE_DELTA):
+        return True
+    if new['debt_count'] > old['debt_count'] or new['top_category'] != old['top_category']:
+        return True
+    for key in ('total_income', 'total_debts'):
+        if abs(new[key] - old[key]) > abs(old[key]) * RECOMMENDATION_RELATIVE_DELTA:
+            return True
+    return False
+
+def refresh_recommendations():
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    stamp = json.dumps(get_data_versions(c, *RECOMMENDATION_TABLES))
+    c.execute('SELECT version, data_versions, fingerprint, source FROM ai_recommendations ORDER BY version DESC LIMIT 1')
+    latest = c.fetchone()
+    retry = recommendation_retry_due()
+    if retry and not (latest and latest[3] == 'rules'):
+        recommendation_retry.update(failures=0, at=None)
+        retry = False
+    if latest and latest[1] == stamp and not retry:
+        conn.close()
+        return
+    
+    summary, overview = collect_recommendation_data()
+    fingerprint = recommendation_fingerprint(c, summary, overview)
+    
+    if latest and not retry and not meaningful_change(json.loads(latest[2]), fingerprint):
+        c.execute('UPDATE ai_recommendations SET data_versions = ? WHERE version = ?', (stamp, latest[0]))
+    else:
+        recommendations, source = generate_recommendations(summary, overview)
+        schedule_recommendation_retry(source)
+        version = latest[0] + 1 if latest else 1
+        c.execute('''INSERT INTO ai_recommendations (version, data_versions, fingerprint, recommendations, source)
+                     VALUES (?, ?, ?, ?, ?)''',
+                  (version, stamp, json.dumps(fingerprint), json.dumps(recommendations), source))
+        c.execute('DELETE FROM ai_recommendations WHERE version <= ?', (version - RECOMMENDATION_HISTORY,))
+    conn.commit()
+    conn.close()
+
+class RecommendationWorker:
+    """Single background thread that recomputes stored recommendations whenever it is poked or a retry is due."""
+    
+    def __init__(self):
+        self.wake = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def poke(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='recommendations', daemon=True)
+                self.thread.start()
+        self.wake.set()
+    
+    def run(self):
+        while True:
+            at = recommendation_retry['at']
+            self.wake.wait(None if at is None else max(at - time.time(), 0))
+            self.wake.clear()
+            try:
+                refresh_recommendations()
+            except Exception as e:
+                print(f"Recommendation refresh failed: {e}")
+                if recommendation_retry_due():
+                    schedule_recommendation_retry('rules')
+
+recommendation_worker = RecommendationWorker()
+
+def read_recommendations():
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    stamp = json.dumps(get_data_versions(c, *RECOMMENDATION_TABLES))
+    c.execute('''SELECT version, data_versions, recommendations, source, created_at
+                 FROM ai_recommendations ORDER BY version DESC LIMIT 1''')
+    latest = c.fetchone()
+    conn.close()
+    
+    if not latest:
+        recommendation_worker.poke()
+        summary, overview = collect_recommendation_data()
+        return get_rule_based_recommendations(summary, overview), {
+            'X-Recommendations-Version': '0',
+            'X-Recommendations-Stale': 'true',
+            'X-Recommendations-Source': 'rules'
+        }
     
+    stale = latest[1] != stamp
+    if stale:
+        recommendation_worker.poke()
+    return json.loads(latest[2]), {
+        'X-Recommendations-Version': str(latest[0]),
+        'X-Recommendations-Stale': 'true' if stale else 'false',
+        'X-Recommendations-Source': latest[3],
+        'X-Recommendations-Computed-At': latest[4]
+    }
+
+@app.route('/api/ai/metrics', methods=['GET'])
+def ai_metrics():
+    return jsonify(admission.metrics())
+
+@app.route('/api/ai/budget-recommendations', methods=['GET'])
+def ai_budget_recommendations():
+    recommendations, headers = read_recommendations()
+    return jsonify(recommendations), 200, headers
+
+@app.after_request
+def schedule_background_work(response):
+    if request.method in ('POST', 'PUT', 'DELETE') and response.status_code < 400 \
+            and not request.path.startswith('/api/ai/'):
+        recommendation_worker.poke()
+    return response
+
+def collect_prediction_data(days: int):
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
     start_date = (datetime.now() - timedelta(days=days*2)).strftime('%Y-%m-%d')
-    c.execute('''SELECT date(date_added) as date, SUM(amount) as total
-                 FROM expenses
-                 WHERE date(date_added) >= ?
-                 GROUP BY date(date_added)
-                 ORDER BY date(date_added)''', (start_date,))
+    source = expense_source(conn, start_date)
+    c.execute(f'''SELECT date(date_added) as date, SUM(amount) as total
+                  FROM {source}
+                  WHERE date(date_added) >= ?
+                  GROUP BY date(date_added)
+                  ORDER BY date(date_added)''', (start_date,))
     
     daily_expenses = [{'date': row['date'], 'amount': row['total']} for row in c.fetchall()]
     conn.close()
-    
-    if len(daily_expenses) < 3:
-        return jsonify({'predicted': 0, 'confidence': 'low', 'message': 'Need more data for accurate predictions'})
-    
+    return daily_expenses
+
+def build_prediction_prompt(daily_expenses, days: int) -> str:
+    return f"""Based on these daily expenses: {json.dumps(daily_expenses[-14:])}
+            Predict expenses for the next {days} days. Return JSON with 'predicted' (number) and 'confidence' (low/medium/high)."""
+
+def get_rule_based_prediction(daily_expenses, days: int) -> Dict:
     recent_avg = sum(d['amount'] for d in daily_expenses[-7:]) / min(7, len(daily_expenses))
     predicted = recent_avg * days
+    return {
+        'predicted': round(predicted, 2),
+        'confidence': 'medium',
+        'message': f'Based on recent spending patterns, you might spend around ${predicted:.2f} in the next {days} days.'
+    }
+
+NOT_ENOUGH_PREDICTION_DATA = {'predicted': 0, 'confidence': 'low', 'message': 'Need more data for accurate predictions'}
+
+@app.route('/api/ai/predict-expenses', methods=['GET'])
+def ai_predict_expenses():
+    period = request.args.get('period', 'month')
+    days = 30 if period == 'month' else 7
     
-    api_key = get_api_key()
-    if api_key and OPENAI_AVAILABLE:
+    daily_expenses = collect_prediction_data(days)
+    if len(daily_expenses) < 3:
+        return jsonify(NOT_ENOUGH_PREDICTION_DATA)
+    
+    prompt = build_prediction_prompt(daily_expenses, days)
+    reply, _ = openai_completion([{"role": "user", "content": prompt}], 100, 0.5, 'predict')
+    if reply:
         try:
-            from openai import OpenAI
-            client = OpenAI(api_key=api_key)
-            
-            prompt = f"""Based on these daily expenses: {json.dumps(daily_expenses[-14:])}
-            Predict expenses for the next {days} days. Return JSON with 'predicted' (number) and 'confidence' (low/medium/high)."""
-            
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=100,
-                temperature=0.5
-            )
-            prediction = json.loads(response.choices[0].message.content.strip())
-            return jsonify(prediction)
-        except:
+            return jsonify(dict(json.loads(reply), source='openai'))
+        except (ValueError, TypeError):
             pass
     
-    return jsonify({
-        'predicted': round(predicted, 2),
-        'confidence': 'medium',
-        'message': f'Based on recent spending patterns, you might spend around ${predicted:.2f} in the next {days} days.'
-    })
+    return jsonify(dict(get_rule_based_prediction(daily_expenses, days), source='rules'))
 
 @app.route('/api/reports/monthly', methods=['GET'])
 def get_monthly_report():
     month = request.args.get('month', datetime.now().strftime('%Y-%m'))
+    if not re.fullmatch(r'\d{4}-\d{2}', month):
+        return jsonify({'error': 'month must be YYYY-MM'}), 400
     
-    conn = sqlite3.connect(DATABASE)
+    conn = analytics_connect()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
@@ -979,11 +3563,12 @@ def get_monthly_report():
                  WHERE strftime('%Y-%m', date_added) = ?''', (month,))
     income = c.fetchone()['total'] or 0
     
-    c.execute('''SELECT c.name, SUM(e.amount) as total, COUNT(e.id) as count
-                 FROM expenses e
-                 JOIN categories c ON e.category_id = c.id
-                 WHERE strftime('%Y-%m', e.date_added) = ?
-                 GROUP BY c.id, c.name''', (month,))
+    source = expense_source(conn, f'{month}-01', f'{month}-31')
+    c.execute(f'''SELECT c.name, SUM(e.amount) as total, COUNT(e.id) as count
+                  FROM {source} e
+                  JOIN categories c ON e.category_id = c.id
+                  WHERE strftime('%Y-%m', e.date_added) = ?
+                  GROUP BY c.id, c.name''', (month,))
     
     category_expenses = [{'name': row['name'], 'total': row['total'], 'count': row['count']} 
                         for row in c.fetchall()]
@@ -1003,31 +3588,32 @@ def get_monthly_report():
 
 @app.route('/api/analysis/patterns', methods=['GET'])
 def get_spending_patterns():
-    conn = sqlite3.connect(DATABASE)
+    conn = analytics_connect()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
+    source = expense_source(conn, (datetime.now() - timedelta(days=31)).strftime('%Y-%m-%d'))
     
-    c.execute('''SELECT strftime('%w', date_added) as day_of_week, 
-                        strftime('%A', date_added) as day_name,
-                        SUM(amount) as total, COUNT(*) as count
-                 FROM expenses
-                 WHERE date(date_added) >= date('now', '-30 days')
-                 GROUP BY day_of_week, day_name
-                 ORDER BY day_of_week''')
+    c.execute(f'''SELECT strftime('%w', date_added) as day_of_week, 
+                         strftime('%A', date_added) as day_name,
+                         SUM(amount) as total, COUNT(*) as count
+                  FROM {source}
+                  WHERE date(date_added) >= date('now', '-30 days')
+                  GROUP BY day_of_week, day_name
+                  ORDER BY day_of_week''')
     
     day_patterns = [{'day': row['day_name'], 'total': row['total'], 'count': row['count']} 
                     for row in c.fetchall()]
     
-    c.execute('''SELECT AVG(amount) as avg, MIN(amount) as min, MAX(amount) as max
-                 FROM expenses
-                 WHERE date(date_added) >= date('now', '-30 days')''')
+    c.execute(f'''SELECT AVG(amount) as avg, MIN(amount) as min, MAX(amount) as max
+                  FROM {source}
+                  WHERE date(date_added) >= date('now', '-30 days')''')
     
     stats = c.fetchone()
     
-    c.execute('''SELECT c.name, SUM(e.amount) as total
-                 FROM expenses e
-                 JOIN categories c ON e.category_id = c.id
-                 WHERE date(e.date_added) >= date('now', '-30 days')
+    c.execute(f'''SELECT c.name, SUM(e.amount) as total
+                  FROM {source} e
+                  JOIN categories c ON e.category_id = c.id
+                  WHERE date(e.date_added) >= date('now', '-30 days')
                  GROUP BY c.id, c.name
                  ORDER BY total DESC
                  LIMIT 1''')
@@ -1047,31 +3633,32 @@ def get_spending_patterns():
 @app.route('/api/export', methods=['GET'])
 def export_data():
     export_type = request.args.get('type', 'expenses')
+    fmt = table_format()
     
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    conn = analytics_connect()
     c = conn.cursor()
+    source = expense_source(conn) if export_type in ('expenses', 'all') else 'expenses'
     
     if export_type == 'expenses':
-        c.execute('''SELECT e.*, c.name as category_name
-                     FROM expenses e
-                     LEFT JOIN categories c ON e.category_id = c.id
-                     ORDER BY e.date_added DESC''')
-        data = [dict(row) for row in c.fetchall()]
+        c.execute(f'''SELECT e.id, e.amount, e.category_id, e.description, e.date_added, c.name as category_name
+                      FROM {source} e
+                      LEFT JOIN categories c ON e.category_id = c.id
+                      ORDER BY e.date_added DESC''')
+        data = fetch_table(c, fmt)
     elif export_type == 'income':
         c.execute('SELECT * FROM income ORDER BY date_added DESC')
-        data = [dict(row) for row in c.fetchall()]
+        data = fetch_table(c, fmt)
     elif export_type == 'all':
-        c.execute('SELECT * FROM expenses')
-        expenses = [dict(row) for row in c.fetchall()]
+        c.execute(f'SELECT {EXPENSE_FIELDS} FROM {source}')
+        expenses = fetch_table(c, fmt)
         c.execute('SELECT * FROM income')
-        income = [dict(row) for row in c.fetchall()]
+        income = fetch_table(c, fmt)
         c.execute('SELECT * FROM savings_goals')
-        goals = [dict(row) for row in c.fetchall()]
+        goals = fetch_table(c, fmt)
         c.execute('SELECT * FROM investments')
-        investments = [dict(row) for row in c.fetchall()]
+        investments = fetch_table(c, fmt)
         c.execute('SELECT * FROM debts')
-        debts = [dict(row) for row in c.fetchall()]
+        debts = fetch_table(c, fmt)
         
         data = {
             'expenses': expenses,
@@ -1084,7 +3671,11 @@ def export_data():
         data = []
     
     conn.close()
-    return jsonify(data)
+    return table_response(data, fmt)
+
+@app.route('/api/snapshot/refresh', methods=['POST'])
+def refresh_snapshot():
+    return jsonify(snapshot_replica.refresh(force=True))
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
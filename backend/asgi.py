@@ -0,0 +1,310 @@
+"""
+ASGI entry point for Budget AI - serves the AI endpoints and the alert stream with async handlers so slow
+LLM calls don't pin worker threads, and runs every other route through the Flask app on a bounded thread pool.
+
+Run with: uvicorn asgi:app --port 5000
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+import app as budget
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+CRUD_WORKERS = int(os.getenv('CRUD_WORKERS', 16))
+
+db_pool = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='budget-db')
+flask_app = WSGIMiddleware(budget.app, workers=CRUD_WORKERS)
+
+openai_clients = {}
+
+request_client = ContextVar('request_client', default=None)
+response_headers = ContextVar('response_headers', default=None)
+
+def get_async_client(api_key: str):
+    if api_key not in openai_clients:
+        from openai import AsyncOpenAI
+        openai_clients[api_key] = AsyncOpenAI(api_key=api_key, base_url=budget.OPENAI_BASE_URL,
+                                              timeout=budget.OPENAI_TIMEOUT, max_retries=budget.OPENAI_MAX_RETRIES)
+    return openai_clients[api_key]
+
+async def run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_pool, fn, *args)
+
+async def acquire_slot(kind: str) -> int:
+    """Async counterpart of AdmissionController.acquire: 0 once this task holds an LLM slot, otherwise the
+    Retry-After seconds, which are also added to the response headers."""
+    admission = budget.admission
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    status, value = admission.enter(kind, request_client.get(),
+                                    lambda retry_after: loop.call_soon_threadsafe(future.set_result, retry_after))
+    if status == 'queued':
+        try:
+            value = await asyncio.wait_for(asyncio.shield(future), budget.LLM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            value = admission.retry_after() if admission.cancel(value) else await future
+        except asyncio.CancelledError:
+            if not admission.cancel(value):
+                future.add_done_callback(lambda done: done.result() or admission.release())
+            raise
+    
+    retry_after = value or 0
+    if retry_after and response_headers.get() is not None:
+        response_headers.get()['Retry-After'] = retry_after
+    return retry_after
+
+async def complete(messages, max_tokens: int, temperature: float, kind: str):
+    api_key = budget.get_api_key()
+    if not (api_key and budget.OPENAI_AVAILABLE) or await acquire_slot(kind):
+        return None, None
+    
+    started = time.monotonic()
+    try:
+        response = await get_async_client(api_key).chat.completions.create(
+            model=budget.OPENAI_MODEL,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        return budget.completion_reply(response)
+    except budget.openai.OpenAIError as e:
+        print(f"OpenAI error: {e}")
+        return None, None
+    finally:
+        budget.admission.release(time.monotonic() - started)
+
+async def ai_chat(data, query):
+    user_message = data.get('message', '')
+    user_data = await run_db(budget.collect_chat_data)
+    
+    messages, usage = budget.build_chat_messages(user_message, user_data)
+    reply, llm_usage = await complete(messages, 300, 0.8, 'chat')
+    if reply is None:
+        return {'response': budget.get_rule_based_response(user_message, user_data), 'usage': usage,
+                'source': 'rules'}
+    usage.update(llm_usage or {})
+    return {'response': reply, 'usage': usage, 'source': 'openai'}
+
+async def stream_chat(data, send):
+    user_message = data.get('message', '')
+    user_data = await run_db(budget.collect_chat_data)
+    messages, usage = budget.build_chat_messages(user_message, user_data)
+    
+    async def emit(event: str, payload):
+        await send({'type': 'http.response.body', 'body': budget.format_sse(None, event, payload).encode(),
+                    'more_body': True})
+    
+    headers = [(b'content-type', b'text/event-stream'),
+               (b'cache-control', b'no-cache'),
+               (b'x-accel-buffering', b'no'),
+               (b'access-control-allow-origin', b'*')]
+    api_key = budget.get_api_key() if budget.OPENAI_AVAILABLE else None
+    retry_after = await acquire_slot('chat') if api_key else 0
+    if retry_after:
+        api_key = None
+        headers.append((b'retry-after', str(retry_after).encode()))
+    
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    text = ''
+    started = time.monotonic()
+    if api_key:
+        try:
+            stream = await get_async_client(api_key).chat.completions.create(
+                model=budget.OPENAI_MODEL,
+                messages=messages,
+                max_tokens=300,
+                temperature=0.8,
+                stream=True,
+                stream_options={'include_usage': True}
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    usage.update(budget.token_usage(chunk.usage))
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    text += delta
+                    await emit('delta', {'text': delta})
+        except budget.openai.OpenAIError as e:
+            print(f"OpenAI error: {e}")
+        finally:
+            budget.admission.release(time.monotonic() - started)
+    
+    if not text:
+        await emit('delta', {'text': budget.get_rule_based_response(user_message, user_data)})
+    await emit('done', {'source': 'openai' if text else 'rules', 'usage': usage})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def ai_categorize_expense(data, query):
+    description = data.get('description', '')
+    category, confidence, source = await run_db(budget.classify_locally, description)
+    if source == 'model' and confidence >= budget.CLASSIFIER_MIN_CONFIDENCE:
+        return {'category': category, 'confidence': confidence, 'source': source}
+    
+    prompt = budget.build_categorize_prompt(description, data.get('amount', 0))
+    reply, _ = await complete([{"role": "user", "content": prompt}], 10, 0.3, 'categorize')
+    if reply:
+        return {'category': reply, 'confidence': None, 'source': 'openai'}
+    return {'category': category, 'confidence': confidence, 'source': source}
+
+async def ai_budget_recommendations(data, query):
+    return await run_db(budget.read_recommendations)
+
+async def ai_predict_expenses(data, query):
+    days = 30 if query.get('period', 'month') == 'month' else 7
+    daily_expenses = await run_db(budget.collect_prediction_data, days)
+    if len(daily_expenses) < 3:
+        return budget.NOT_ENOUGH_PREDICTION_DATA
+    
+    prompt = budget.build_prediction_prompt(daily_expenses, days)
+    reply, _ = await complete([{"role": "user", "content": prompt}], 100, 0.5, 'predict')
+    if reply:
+        try:
+            return dict(json.loads(reply), source='openai')
+        except (ValueError, TypeError):
+            pass
+    return dict(budget.get_rule_based_prediction(daily_expenses, days), source='rules')
+
+AI_ROUTES = {
+    ('POST', '/api/ai/chat'): ai_chat,
+    ('POST', '/api/ai/categorize'): ai_categorize_expense,
+    ('GET', '/api/ai/budget-recommendations'): ai_budget_recommendations,
+    ('GET', '/api/ai/predict-expenses'): ai_predict_expenses,
+}
+
+AI_STREAM_ROUTES = {
+    ('POST', '/api/ai/chat'): stream_chat,
+}
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def send_json(send, payload, status: int = 200, headers=None):
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode()),
+                    (b'access-control-allow-origin', b'*')] +
+                   [(k.lower().encode(), str(v).encode()) for k, v in (headers or {}).items()]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def stream_alerts(scope, receive, send):
+    headers = dict(scope['headers'])
+    query = {k: v[-1] for k, v in parse_qs(scope['query_string'].decode()).items()}
+    last_event_id = headers.get(b'last-event-id', b'').decode() or query.get('last_event_id')
+    try:
+        last_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_id = None
+    
+    bus = budget.alert_bus
+    if bus.levels is None:
+        await run_db(budget.refresh_alert_levels)
+    
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    listener = lambda: loop.call_soon_threadsafe(wake.set)
+    bus.listeners.add(listener)
+    
+    async def emit(text: str):
+        await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+    
+    async def snapshot():
+        event_id = bus.last_id
+        await emit(budget.format_sse(event_id, 'snapshot', await run_db(budget.collect_alerts)))
+        return event_id
+    
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    
+    async def pump(last_id):
+        await emit("retry: 3000\n\n")
+        if last_id is None or bus.since(last_id) is None:
+            last_id = await snapshot()
+        
+        while True:
+            wake.clear()
+            pending = bus.since(last_id)
+            if pending is None:
+                last_id = await snapshot()
+            elif pending:
+                for event_id, event, data in pending:
+                    last_id = event_id
+                    await emit(budget.format_sse(event_id, event, data))
+            else:
+                try:
+                    await asyncio.wait_for(wake.wait(), budget.ALERT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if bus.month != datetime.now().strftime('%Y-%m'):
+                        await run_db(budget.refresh_alert_levels)
+                    await emit(": heartbeat\n\n")
+    
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream'),
+                    (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no'),
+                    (b'access-control-allow-origin', b'*')]
+    })
+    tasks = [asyncio.ensure_future(pump(last_id)), asyncio.ensure_future(disconnected())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        bus.listeners.discard(listener)
+        for task in tasks:
+            task.cancel()
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                db_pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    if scope['type'] == 'http':
+        if scope['method'] == 'GET' and scope['path'] == '/api/alerts/stream':
+            return await stream_alerts(scope, receive, send)
+        
+        handler = AI_ROUTES.get((scope['method'], scope['path']))
+        if handler:
+            request_client.set(dict(scope['headers']).get(b'x-client-id', b'').decode()
+                               or (scope.get('client') or [None])[0])
+            response_headers.set({})
+            body = await read_body(receive)
+            try:
+                data = json.loads(body) if body else {}
+            except ValueError:
+                return await send_json(send, {'error': 'Invalid JSON body'}, 400)
+            stream_handler = AI_STREAM_ROUTES.get((scope['method'], scope['path']))
+            if stream_handler and data.get('stream'):
+                return await stream_handler(data, send)
+            query = {k: v[-1] for k, v in parse_qs(scope['query_string'].decode()).items()}
+            result = await handler(data, query)
+            headers = response_headers.get()
+            if isinstance(result, tuple):
+                result, extra = result
+                headers.update(extra)
+            return await send_json(send, result, headers=headers)
+    
+    await flask_app(scope, receive, send)
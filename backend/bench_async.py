@@ -0,0 +1,111 @@
+"""
+Compares the threaded and async serving modes with a mock LLM: many concurrent chat requests in flight
+while a few clients measure CRUD latency.
+
+Run with: python bench_async.py --chat-clients 200 --llm-latency 1.0 --duration 15
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODES = {
+    'threaded': 'asgi:flask_app',
+    'async': 'asgi:app',
+}
+
+def start(args, env, cwd):
+    return subprocess.Popen(args, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def wait_ready(port: int, path: str):
+    for _ in range(100):
+        try:
+            request(port, 'GET', path)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'port {port} did not start')
+
+def request(port: int, method: str, path: str, payload=None, conn=None):
+    conn = conn or http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    body = json.dumps(payload) if payload is not None else None
+    conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    return response.status, response.read()
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+def run_load(port: int, chat_clients: int, crud_clients: int, duration: float):
+    chat_latencies, crud_latencies = [], []
+    deadline = time.perf_counter() + duration
+    
+    def worker(method, path, payload, latencies, pause):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            request(port, method, path, payload, conn)
+            latencies.append(time.perf_counter() - start)
+            time.sleep(pause)
+    
+    threads = [threading.Thread(target=worker, args=('POST', '/api/ai/chat', {'message': 'How can I save more?'},
+                                                     chat_latencies, 0))
+               for _ in range(chat_clients)]
+    threads += [threading.Thread(target=worker, args=('GET', '/api/categories', None, crud_latencies, 0.05))
+                for _ in range(crud_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return chat_latencies, crud_latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chat-clients', type=int, default=200)
+    parser.add_argument('--crud-clients', type=int, default=4)
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--mode', choices=['threaded', 'async', 'both'], default='both')
+    args = parser.parse_args()
+    
+    workdir = tempfile.mkdtemp(prefix='budget-bench-')
+    env = dict(os.environ, OPENAI_API_KEY='sk-mock', OPENAI_BASE_URL='http://127.0.0.1:8001/v1',
+               LLM_CONCURRENCY=str(args.chat_clients), LLM_CLIENT_RATE='1000', LLM_CLIENT_BURST='1000')
+    llm = start([sys.executable, os.path.join(BACKEND_DIR, 'mock_llm.py'), '--latency', str(args.llm_latency)],
+                env, workdir)
+    wait_ready(8001, '/')
+    
+    print(f"{args.chat_clients} concurrent chat clients, LLM latency {args.llm_latency}s, {args.duration}s per mode")
+    print(f"{'mode':<10}{'chat req/s':>12}{'chat p50':>10}{'chat p99':>10}{'crud p50':>10}{'crud p99':>10}")
+    try:
+        for mode in (['threaded', 'async'] if args.mode == 'both' else [args.mode]):
+            server = start([sys.executable, '-m', 'uvicorn', MODES[mode], '--app-dir', BACKEND_DIR,
+                            '--port', '5099', '--lifespan', 'off', '--log-level', 'warning'], env, workdir)
+            try:
+                wait_ready(5099, '/api/health')
+                chat, crud = run_load(5099, args.chat_clients, args.crud_clients, args.duration)
+                print(f"{mode:<10}{len(chat) / args.duration:>12.1f}"
+                      f"{statistics.median(chat) * 1000 if chat else float('nan'):>9.0f}ms"
+                      f"{percentile(chat, 99) * 1000:>8.0f}ms"
+                      f"{statistics.median(crud) * 1000 if crud else float('nan'):>8.1f}ms"
+                      f"{percentile(crud, 99) * 1000:>8.1f}ms")
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        llm.terminate()
+        llm.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares payload size and CPU time of the list endpoints in plain JSON, columnar JSON and MessagePack,
+with and without gzip/brotli.
+
+Run with: python bench_formats.py --expenses 20000 --repeat 10
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FORMATS = ['json', 'columnar', 'msgpack']
+ENCODINGS = ['identity', 'gzip', 'br']
+ROUTES = ['/api/expenses?period=all', '/api/export?type=all']
+
+def seed(count: int):
+    rng = random.Random(7)
+    words = ['coffee', 'lunch', 'bus pass', 'movie', 'groceries', 'book', 'phone bill', 'snacks', 'gift']
+    start = datetime.now() - timedelta(days=730)
+    conn = sqlite3.connect('budget.db')
+    c = conn.cursor()
+    category_ids = [row[0] for row in c.execute('SELECT id FROM categories')]
+    c.executemany('INSERT INTO expenses (amount, category_id, description, date_added) VALUES (?, ?, ?, ?)',
+                  [(round(rng.uniform(1, 120), 2), rng.choice(category_ids), f'{rng.choice(words)} #{i}',
+                    (start + timedelta(minutes=rng.randint(0, 730 * 1440))).strftime('%Y-%m-%d %H:%M:%S'))
+                   for i in range(count)])
+    c.executemany('INSERT INTO income (amount, source, period) VALUES (?, ?, ?)',
+                  [(round(rng.uniform(10, 500), 2), 'Job', 'weekly') for _ in range(count // 100)])
+    conn.commit()
+    conn.close()
+
+def measure(client, path: str, fmt: str, encoding: str, repeat: int):
+    headers = {'Accept-Encoding': encoding}
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        response = client.get(f'{path}&format={fmt}', headers=headers)
+        timings.append(time.process_time() - start)
+    return len(response.get_data()), statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--expenses', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='budget-bench-'))
+    sys.path.insert(0, BACKEND_DIR)
+    import app as budget
+    seed(args.expenses)
+    client = budget.app.test_client()
+
+    print(f"{args.expenses} expenses, median of {args.repeat} requests (CPU time includes the test client)")
+    for path in ROUTES:
+        baseline = None
+        print(f"\n{path}")
+        print(f"{'format':<10}{'encoding':<10}{'bytes':>12}{'ratio':>8}{'cpu':>10}")
+        for fmt in FORMATS:
+            for encoding in ENCODINGS:
+                size, cpu = measure(client, path, fmt, encoding, args.repeat)
+                baseline = baseline or size
+                print(f"{fmt:<10}{encoding:<10}{size:>12,}{size / baseline:>8.2f}{cpu * 1000:>8.1f}ms")
+
+if __name__ == '__main__':
+    main()
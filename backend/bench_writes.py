@@ -0,0 +1,85 @@
+"""
+Compares write throughput with one commit per request (WRITE_MODE=direct) against the group-commit writer
+(WRITE_MODE=group) while many clients add expenses and income and update goals at once.
+
+Run with: python bench_writes.py --clients 32 --duration 10 --dir /path/on/a/real/disk
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from bench_async import BACKEND_DIR, start, wait_ready, percentile
+
+BACKEND_PORT = 5099
+
+WRITES = [
+    ('POST', '/api/expenses', {'amount': 4.5, 'category_id': 1, 'description': 'coffee'}),
+    ('POST', '/api/income', {'amount': 20, 'source': 'Allowance', 'period': 'weekly'}),
+    ('PUT', '/api/goals/1', {'current_amount': 50}),
+]
+
+def run_load(clients: int, duration: float):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    
+    def worker(index):
+        conn = http.client.HTTPConnection('127.0.0.1', BACKEND_PORT, timeout=60)
+        i = index
+        while time.perf_counter() < deadline:
+            method, path, payload = WRITES[i % len(WRITES)]
+            i += 1
+            start_time = time.perf_counter()
+            conn.request(method, path, body=json.dumps(payload), headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            (latencies if response.status in (200, 201) else errors).append(time.perf_counter() - start_time)
+    
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--window-ms', type=float, default=2, help='GROUP_COMMIT_WINDOW_MS')
+    parser.add_argument('--max-group', type=int, default=64, help='GROUP_COMMIT_MAX')
+    parser.add_argument('--mode', choices=['direct', 'group', 'both'], default='both')
+    parser.add_argument('--dir', help='where to put the database; fsync cost depends on the disk (tmpfs hides it)')
+    args = parser.parse_args()
+    
+    print(f"{args.clients} concurrent writers, {args.duration}s per mode, group window {args.window_ms}ms "
+          f"up to {args.max_group} writes")
+    print(f"{'mode':<10}{'writes/s':>10}{'p50':>10}{'p99':>10}{'errors':>8}")
+    for mode in (['direct', 'group'] if args.mode == 'both' else [args.mode]):
+        workdir = tempfile.mkdtemp(prefix='budget-bench-', dir=args.dir)
+        env = dict(os.environ, WRITE_MODE=mode, GROUP_COMMIT_WINDOW_MS=str(args.window_ms),
+                   GROUP_COMMIT_MAX=str(args.max_group), CRUD_WORKERS=str(max(args.clients, 16)))
+        server = start([sys.executable, '-m', 'uvicorn', 'asgi:flask_app', '--app-dir', BACKEND_DIR,
+                        '--port', str(BACKEND_PORT), '--lifespan', 'off', '--log-level', 'warning'], env, workdir)
+        try:
+            wait_ready(BACKEND_PORT, '/api/health')
+            conn = http.client.HTTPConnection('127.0.0.1', BACKEND_PORT, timeout=60)
+            conn.request('POST', '/api/goals', body=json.dumps({'name': 'Bike', 'target_amount': 300}),
+                         headers={'Content-Type': 'application/json'})
+            conn.getresponse().read()
+            
+            latencies, errors = run_load(args.clients, args.duration)
+            print(f"{mode:<10}{len(latencies) / args.duration:>10.0f}"
+                  f"{statistics.median(latencies) * 1000 if latencies else float('nan'):>8.1f}ms"
+                  f"{percentile(latencies, 99) * 1000:>8.1f}ms{len(errors):>8}")
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""
+Load-tests the AI endpoints against the OpenAI-compatible stub in mock_llm.py, with configurable latency
+distributions and 429/500 rates. Concurrent clients drive a weighted mix of chat, categorize, predict and
+recommendation requests, each with its own X-Client-Id; the report covers throughput, tail latency, error, fallback
+and shed rates, the answer sources, admission queue stats and the tokens the stub served. Admission limits come from
+the usual LLM_* environment variables.
+
+Run with: python loadtest.py --clients 50 --duration 20 --llm-latency 0.8 --distribution lognormal --rate-429 0.1
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from bench_async import BACKEND_DIR, MODES, start, wait_ready, percentile
+
+BACKEND_PORT = 5099
+LLM_PORT = 8001
+
+QUESTIONS = ['How can I save more?', 'Am I spending too much on food?', 'Should I pay off my debt first?',
+             'How am I doing this month?', 'Where is my money going?']
+DESCRIPTIONS = ['coffee at the corner cafe', 'uber to airport', 'netflix subscription', 'groceries',
+                'zq market 4471', 'birthday gift for mom', 'parking meter', 'misc online order']
+
+FALLBACK_SOURCES = {'rules', 'keywords'}
+
+def seed(workdir: str, rng: random.Random):
+    """Gives the predict and recommendation endpoints enough history to call the LLM."""
+    conn = sqlite3.connect(os.path.join(workdir, 'budget.db'))
+    c = conn.cursor()
+    category_ids = [row[0] for row in c.execute('SELECT id FROM categories')]
+    now = datetime.now()
+    c.executemany('INSERT INTO expenses (amount, category_id, description, date_added) VALUES (?, ?, ?, ?)',
+                  [(round(rng.uniform(3, 80), 2), rng.choice(category_ids), rng.choice(DESCRIPTIONS),
+                    (now - timedelta(days=rng.randint(0, 29), minutes=rng.randint(0, 1440))).strftime('%Y-%m-%d %H:%M:%S'))
+                   for _ in range(200)])
+    c.execute("INSERT INTO income (amount, source, period) VALUES (2400, 'Job', 'monthly')")
+    conn.commit()
+    conn.close()
+
+def endpoint_request(name: str, rng: random.Random, stream: bool):
+    if name == 'chat':
+        return 'POST', '/api/ai/chat', {'message': rng.choice(QUESTIONS), 'stream': stream}
+    if name == 'categorize':
+        return 'POST', '/api/ai/categorize', {'description': rng.choice(DESCRIPTIONS),
+                                              'amount': round(rng.uniform(3, 80), 2)}
+    if name == 'predict':
+        return 'GET', '/api/ai/predict-expenses?period=month', None
+    return 'GET', '/api/ai/budget-recommendations', None
+
+def read_source(name: str, response):
+    """Reads the body and returns (source, time to first delta) - TTFT is only known for streamed chats."""
+    if response.getheader('Content-Type', '').startswith('text/event-stream'):
+        first_delta, event, source = None, None, None
+        while True:
+            line = response.readline()
+            if not line:
+                return source, first_delta
+            line = line.decode().strip()
+            if line.startswith('event: '):
+                event = line[7:]
+                if event == 'delta' and first_delta is None:
+                    first_delta = time.perf_counter()
+            elif line.startswith('data: ') and event == 'done':
+                source = json.loads(line[6:])['source']
+    
+    body = response.read()
+    if name == 'recommendations':
+        return response.getheader('X-Recommendations-Source'), None
+    if response.status != 200:
+        return None, None
+    return json.loads(body).get('source'), None
+
+def get_json(port: int, path: str):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', path)
+    return json.loads(conn.getresponse().read())
+
+def run_load(clients: int, duration: float, mix, stream: bool, seed_value: int):
+    results = {name: {'latencies': [], 'ttft': [], 'errors': 0, 'shed': 0, 'sources': Counter()} for name in mix}
+    names, weights = list(mix), list(mix.values())
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    
+    def worker(index):
+        rng = random.Random(seed_value * 1000 + index)
+        conn = http.client.HTTPConnection('127.0.0.1', BACKEND_PORT, timeout=120)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            method, path, payload = endpoint_request(name, rng, stream)
+            start_time = time.perf_counter()
+            try:
+                conn.request(method, path, body=json.dumps(payload) if payload is not None else None,
+                             headers={'Content-Type': 'application/json', 'X-Client-Id': f'loadtest-{index}'})
+                response = conn.getresponse()
+                source, first_delta = read_source(name, response)
+                ok, shed = response.status == 200, response.getheader('Retry-After') is not None
+            except (OSError, http.client.HTTPException, ValueError):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', BACKEND_PORT, timeout=120)
+                source, first_delta, ok, shed = None, None, False, False
+            elapsed = time.perf_counter() - start_time
+    
+            with lock:
+                result = results[name]
+                if not ok:
+                    result['errors'] += 1
+                    continue
+                result['latencies'].append(elapsed)
+                result['shed'] += shed
+                result['sources'][source or 'none'] += 1
+                if first_delta is not None:
+                    result['ttft'].append(first_delta - start_time)
+    
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def report(mode: str, results, before, after, admission, duration: float):
+    print(f"\n{mode}")
+    print(f"{'endpoint':<16}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'errors':>8}{'fallback':>10}{'shed':>8}"
+          "  sources")
+    for name, result in results.items():
+        latencies, sources = result['latencies'], result['sources']
+        total = len(latencies) + result['errors']
+        if not total:
+            continue
+        fallback = sum(count for source, count in sources.items() if source in FALLBACK_SOURCES)
+        mix = ', '.join(f"{source} {count}" for source, count in sources.most_common())
+        print(f"{name:<16}{len(latencies) / duration:>8.1f}"
+              f"{percentile(latencies, 50) * 1000:>7.0f}ms{percentile(latencies, 95) * 1000:>7.0f}ms"
+              f"{percentile(latencies, 99) * 1000:>7.0f}ms{result['errors'] / total:>8.1%}"
+              f"{fallback / len(latencies) if latencies else 0:>10.1%}"
+              f"{result['shed'] / len(latencies) if latencies else 0:>8.1%}  {mix}")
+        if result['ttft']:
+            print(f"{'  first token':<16}{'':>8}{percentile(result['ttft'], 50) * 1000:>7.0f}ms"
+                  f"{percentile(result['ttft'], 95) * 1000:>7.0f}ms{percentile(result['ttft'], 99) * 1000:>7.0f}ms")
+    
+    calls = after['requests'] - before['requests']
+    statuses = Counter(after['by_status'])
+    statuses.subtract(before['by_status'])
+    served = sum(len(result['latencies']) for result in results.values())
+    prompt_tokens = after['prompt_tokens'] - before['prompt_tokens']
+    completion_tokens = after['completion_tokens'] - before['completion_tokens']
+    print(f"LLM: {calls} calls ({calls / served if served else 0:.2f} per request), "
+          + ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items()) if count)
+          + f"; {prompt_tokens:,} prompt + {completion_tokens:,} completion tokens "
+          f"({(prompt_tokens + completion_tokens) / duration:,.0f}/s)")
+    print(f"Admission: {admission['admitted']} admitted, {admission['queued']} queued "
+          f"(max depth {admission['max_queue_depth']}, wait p50 {admission['wait_ms']['p50']}ms "
+          f"p99 {admission['wait_ms']['p99']}ms), shed {admission['shed_rate_limited']} rate limited, "
+          f"{admission['shed_queue_full'] + admission['shed_evicted']} queue full, {admission['shed_timeout']} timed out")
+
+def parse_mix(value: str):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {'chat', 'categorize', 'predict', 'recommendations'}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--mode', choices=['threaded', 'async', 'both'], default='both')
+    parser.add_argument('--mix', type=parse_mix, default='chat=4,categorize=3,predict=2,recommendations=1',
+                        help='weighted endpoint mix, e.g. chat=1,categorize=1')
+    parser.add_argument('--stream', action='store_true', help='stream chat replies and measure time to first token')
+    parser.add_argument('--llm-latency', type=float, default=0.8)
+    parser.add_argument('--distribution', default='lognormal')
+    parser.add_argument('--sigma', type=float, default=0.5)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--rate-500', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--chunk-delay', type=float, default=0.02)
+    parser.add_argument('--max-retries', type=int, help='OPENAI_MAX_RETRIES for the backend')
+    parser.add_argument('--timeout', type=float, help='OPENAI_TIMEOUT for the backend')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+    
+    workdir = tempfile.mkdtemp(prefix='budget-loadtest-')
+    env = dict(os.environ, OPENAI_API_KEY='sk-mock', OPENAI_BASE_URL=f'http://127.0.0.1:{LLM_PORT}/v1')
+    if args.max_retries is not None:
+        env['OPENAI_MAX_RETRIES'] = str(args.max_retries)
+    if args.timeout is not None:
+        env['OPENAI_TIMEOUT'] = str(args.timeout)
+    llm = start([sys.executable, os.path.join(BACKEND_DIR, 'mock_llm.py'), '--port', str(LLM_PORT),
+                 '--latency', str(args.llm_latency), '--distribution', args.distribution, '--sigma', str(args.sigma),
+                 '--rate-429', str(args.rate_429), '--rate-500', str(args.rate_500),
+                 '--retry-after', str(args.retry_after), '--chunk-delay', str(args.chunk_delay),
+                 '--seed', str(args.seed)], env, workdir)
+    wait_ready(LLM_PORT, '/stats')
+    
+    print(f"{args.clients} clients for {args.duration}s, LLM {args.distribution} latency mean {args.llm_latency}s, "
+          f"429 rate {args.rate_429:.0%}, 500 rate {args.rate_500:.0%}{', streaming chat' if args.stream else ''}")
+    try:
+        for index, mode in enumerate(['threaded', 'async'] if args.mode == 'both' else [args.mode]):
+            server = start([sys.executable, '-m', 'uvicorn', MODES[mode], '--app-dir', BACKEND_DIR,
+                            '--port', str(BACKEND_PORT), '--lifespan', 'off', '--log-level', 'warning'], env, workdir)
+            try:
+                wait_ready(BACKEND_PORT, '/api/health')
+                if index == 0:
+                    seed(workdir, random.Random(args.seed))
+                before = get_json(LLM_PORT, '/stats')
+                results = run_load(args.clients, args.duration, args.mix, args.stream, args.seed)
+                report(mode, results, before, get_json(LLM_PORT, '/stats'),
+                       get_json(BACKEND_PORT, '/api/ai/metrics'), args.duration)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        llm.terminate()
+        llm.wait()
+
+if __name__ == '__main__':
+    main()
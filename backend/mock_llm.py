@@ -0,0 +1,144 @@
+"""
+Minimal OpenAI-compatible chat completions stub for benchmarking the AI endpoints locally. Latency can follow a
+fixed, uniform, exponential or lognormal distribution, a share of requests can fail with 429 or 500, and
+`stream: true` requests are answered with SSE chunks. GET /stats reports requests, statuses and tokens served.
+
+Run with: python mock_llm.py --port 8001 --latency 1.0 --distribution lognormal --rate-429 0.05
+Then point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:8001/v1 and any OPENAI_API_KEY.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from collections import Counter
+
+LATENCY = 1.0
+DISTRIBUTION = 'fixed'
+SIGMA = 0.5
+RATE_429 = 0.0
+RATE_500 = 0.0
+RETRY_AFTER = 1.0
+CHUNK_DELAY = 0.02
+
+DISTRIBUTIONS = ['fixed', 'uniform', 'exponential', 'lognormal']
+
+rng = random.Random()
+stats = {'requests': 0, 'by_status': Counter(), 'prompt_tokens': 0, 'completion_tokens': 0, 'streamed': 0}
+
+def reply_for(prompt: str) -> str:
+    if 'Categorize this expense' in prompt:
+        return 'Food'
+    if 'budget recommendations' in prompt:
+        return json.dumps([{'title': 'Cook at home', 'description': 'Cut restaurant spending by a third.'}])
+    if 'Predict expenses' in prompt:
+        return json.dumps({'predicted': 420.0, 'confidence': 'medium'})
+    return 'Try saving 20% of every paycheck before you spend anything.'
+
+def sample_latency() -> float:
+    """Draws a latency with mean LATENCY from the configured distribution."""
+    if DISTRIBUTION == 'uniform':
+        return rng.uniform(0, 2 * LATENCY)
+    if DISTRIBUTION == 'exponential':
+        return rng.expovariate(1 / LATENCY) if LATENCY > 0 else 0
+    if DISTRIBUTION == 'lognormal':
+        return rng.lognormvariate(math.log(LATENCY) - SIGMA ** 2 / 2, SIGMA) if LATENCY > 0 else 0
+    return LATENCY
+
+def completion_chunks(completion_id: str, model: str, content: str, usage):
+    base = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model}
+    yield dict(base, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])
+    for i, word in enumerate(content.split(' ')):
+        text = word if i == 0 else ' ' + word
+        yield dict(base, choices=[{'index': 0, 'delta': {'content': text}, 'finish_reason': None}])
+    yield dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+    if usage:
+        yield dict(base, choices=[], usage=usage)
+
+async def respond(send, status: int, payload, headers=()):
+    data = json.dumps(payload).encode()
+    stats['by_status'][status] += 1
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')] + list(headers)})
+    await send({'type': 'http.response.body', 'body': data})
+
+async def app(scope, receive, send):
+    if scope['type'] != 'http':
+        return
+    
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    
+    path = scope['path'].rstrip('/')
+    if path == '/stats':
+        data = json.dumps(stats).encode()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json')]})
+        return await send({'type': 'http.response.body', 'body': data})
+    if path != '/v1/chat/completions':
+        return await respond(send, 404, {'error': {'message': 'Not found'}})
+    
+    stats['requests'] += 1
+    roll = rng.random()
+    if roll < RATE_429:
+        return await respond(send, 429, {'error': {'message': 'Rate limit reached', 'type': 'requests',
+                                                   'code': 'rate_limit_exceeded'}},
+                             [(b'retry-after', str(RETRY_AFTER).encode())])
+    
+    request = json.loads(body or b'{}')
+    await asyncio.sleep(sample_latency())
+    if roll < RATE_429 + RATE_500:
+        return await respond(send, 500, {'error': {'message': 'The server had an error', 'type': 'server_error'}})
+    
+    prompt = '\n'.join(m.get('content', '') for m in request.get('messages', []))
+    content = reply_for(prompt)
+    usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4,
+             'total_tokens': (len(prompt) + len(content)) // 4}
+    stats['prompt_tokens'] += usage['prompt_tokens']
+    stats['completion_tokens'] += usage['completion_tokens']
+    completion_id = f'chatcmpl-mock-{time.time_ns()}'
+    model = request.get('model', 'mock')
+    
+    if not request.get('stream'):
+        return await respond(send, 200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage
+        })
+    
+    stats['streamed'] += 1
+    stats['by_status'][200] += 1
+    include_usage = (request.get('stream_options') or {}).get('include_usage')
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+    for chunk in completion_chunks(completion_id, model, content, usage if include_usage else None):
+        await send({'type': 'http.response.body', 'body': f"data: {json.dumps(chunk)}\n\n".encode(),
+                    'more_body': True})
+        await asyncio.sleep(CHUNK_DELAY)
+    await send({'type': 'http.response.body', 'body': b"data: [DONE]\n\n"})
+
+if __name__ == '__main__':
+    import uvicorn
+    
+    parser = argparse.ArgumentParser(description='OpenAI-compatible stub server')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=1.0, help='mean seconds per completion')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='fixed')
+    parser.add_argument('--sigma', type=float, default=0.5, help='lognormal shape; higher means a heavier tail')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='share of requests rejected as rate limited')
+    parser.add_argument('--rate-500', type=float, default=0.0, help='share of requests failing with a server error')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='seconds sent in Retry-After with a 429')
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help='seconds between streamed chunks')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    LATENCY, DISTRIBUTION, SIGMA = args.latency, args.distribution, args.sigma
+    RATE_429, RATE_500, RETRY_AFTER, CHUNK_DELAY = args.rate_429, args.rate_500, args.retry_after, args.chunk_delay
+    rng.seed(args.seed)
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
@@ -21,23 +21,35 @@ function App() {
 
   const refreshData = () => {
     setRefreshKey(prev => prev + 1)
-    loadAlerts()
   }
 
-  const loadAlerts = async () => {
-    try {
-      const response = await fetch('/api/alerts')
-      const data = await response.json()
-      setAlerts(data)
-    } catch (error) {
-      console.error('Error loading alerts:', error)
+  useEffect(() => {
+    const source = new EventSource('/api/alerts/stream')
+
+    source.addEventListener('snapshot', (event) => {
+      setAlerts(JSON.parse(event.data))
+    })
+
+    source.addEventListener('alert', (event) => {
+      const change = JSON.parse(event.data)
+      setAlerts(prev => {
+        const others = prev.filter(alert =>
+          alert.category !== change.category || alert.type === 'unusual_expense'
+        )
+        return change.alert ? [change.alert, ...others] : others
+      })
+    })
+
+    source.addEventListener('anomaly', (event) => {
+      const alert = JSON.parse(event.data)
+      setAlerts(prev => [...prev, alert])
+    })
+
+    source.onerror = () => {
+      console.error('Alert stream disconnected, reconnecting...')
     }
-  }
 
-  useEffect(() => {
-    loadAlerts()
-    const interval = setInterval(loadAlerts, 30000)
-    return () => clearInterval(interval)
+    return () => source.close()
   }, [])
 
   const tabs = [
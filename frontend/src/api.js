@@ -16,8 +16,19 @@ export const api = {
 
   getExpenses: (period = 'month') => axios.get(`${API_BASE}/expenses?period=${period}`),
   addExpense: (data) => axios.post(`${API_BASE}/expenses`, data),
+  updateExpense: (id, data) => axios.put(`${API_BASE}/expenses/${id}`, data),
   deleteExpense: (id) => axios.delete(`${API_BASE}/expenses/${id}`),
 
+  importStatement: (file, mapping = {}) => {
+    const form = new FormData()
+    form.append('file', file)
+    form.append('mapping', JSON.stringify(mapping))
+    return axios.post(`${API_BASE}/import`, form)
+  },
+  getImportJob: (id) => axios.get(`${API_BASE}/import/${id}`),
+
+  search: (q, params = {}) => axios.get(`${API_BASE}/search`, { params: { q, ...params } }),
+
   getSummary: (period = 'month') => axios.get(`${API_BASE}/summary?period=${period}`),
 
   chat: (message) => axios.post(`${API_BASE}/ai/chat`, { message }),
@@ -26,6 +37,7 @@ export const api = {
   addGoal: (data) => axios.post(`${API_BASE}/goals`, data),
   updateGoal: (id, data) => axios.put(`${API_BASE}/goals/${id}`, data),
   deleteGoal: (id) => axios.delete(`${API_BASE}/goals/${id}`),
+  getGoalProjections: () => axios.get(`${API_BASE}/goals/projections`),
 
   getTrends: (period = 'month') => axios.get(`${API_BASE}/trends?period=${period}`),
 
@@ -35,11 +47,14 @@ export const api = {
   addInvestment: (data) => axios.post(`${API_BASE}/investments`, data),
   updateInvestment: (id, data) => axios.put(`${API_BASE}/investments/${id}`, data),
   deleteInvestment: (id) => axios.delete(`${API_BASE}/investments/${id}`),
+  updateInvestmentValues: (values, date) => axios.put(`${API_BASE}/investments/values`, { values, date }),
+  getInvestmentHistory: (id, params = {}) => axios.get(`${API_BASE}/investments/${id}/history`, { params }),
 
   getDebts: () => axios.get(`${API_BASE}/debts`),
   addDebt: (data) => axios.post(`${API_BASE}/debts`, data),
   updateDebt: (id, data) => axios.put(`${API_BASE}/debts/${id}`, data),
   deleteDebt: (id) => axios.delete(`${API_BASE}/debts/${id}`),
+  getDebtPlan: (params = {}) => axios.get(`${API_BASE}/debts/plan`, { params }),
 
   getRecurring: () => axios.get(`${API_BASE}/recurring`),
   addRecurring: (data) => axios.post(`${API_BASE}/recurring`, data),
@@ -77,6 +77,16 @@ export default function ExpenseTracker({ onUpdate }) {
     }
   }
 
+  const handleChangeCategory = async (id, categoryId) => {
+    try {
+      await api.updateExpense(id, { category_id: categoryId })
+      loadData()
+      if (onUpdate) onUpdate()
+    } catch (error) {
+      console.error('Error updating expense:', error)
+    }
+  }
+
   const handleDeleteExpense = async (id) => {
     if (window.confirm('Are you sure you want to delete this expense?')) {
       try {
@@ -103,11 +113,6 @@ export default function ExpenseTracker({ onUpdate }) {
     return category?.color || '#3B82F6'
   }
 
-  const getCategoryName = (categoryId) => {
-    const category = categories.find(c => c.id === categoryId)
-    return category?.name || 'Unknown'
-  }
-
   const totalExpenses = expenses.reduce((sum, expense) => sum + expense.amount, 0)
 
   if (loading) {
@@ -214,7 +219,15 @@ export default function ExpenseTracker({ onUpdate }) {
                     ${expense.amount.toFixed(2)}
                   </p>
                   <div className="flex items-center gap-2 text-sm text-gray-600">
-                    <span className="font-medium">{getCategoryName(expense.category_id)}</span>
+                    <select
+                      value={expense.category_id}
+                      onChange={(e) => handleChangeCategory(expense.id, parseInt(e.target.value))}
+                      className="font-medium bg-transparent focus:outline-none cursor-pointer"
+                    >
+                      {categories.map((cat) => (
+                        <option key={cat.id} value={cat.id}>{cat.name}</option>
+                      ))}
+                    </select>
                     {expense.description && (
                       <>
                         <span>•</span>
@@ -7,6 +7,7 @@ import { Plus, Trash2, Target, TrendingUp, Calendar } from 'lucide-react'
 
 export default function SavingsGoals({ onUpdate }) {
   const [goals, setGoals] = useState([])
+  const [projections, setProjections] = useState({})
   const [loading, setLoading] = useState(true)
   const [showForm, setShowForm] = useState(false)
   const [formData, setFormData] = useState({
@@ -25,6 +26,7 @@ export default function SavingsGoals({ onUpdate }) {
       setLoading(true)
       const response = await api.getGoals()
       setGoals(response.data)
+      loadProjections()
     } catch (error) {
       console.error('Error loading goals:', error)
     } finally {
@@ -32,6 +34,17 @@ export default function SavingsGoals({ onUpdate }) {
     }
   }
 
+  const loadProjections = async () => {
+    try {
+      const response = await api.getGoalProjections()
+      const byGoal = {}
+      response.data.projections.forEach(p => { byGoal[p.goal_id] = p })
+      setProjections(byGoal)
+    } catch (error) {
+      console.error('Error loading projections:', error)
+    }
+  }
+
   const handleAddGoal = async (e) => {
     e.preventDefault()
     try {
@@ -167,6 +180,7 @@ export default function SavingsGoals({ onUpdate }) {
             const progress = calculateProgress(goal.current_amount, goal.target_amount)
             const daysRemaining = getDaysRemaining(goal.deadline)
             const remaining = goal.target_amount - goal.current_amount
+            const projection = projections[goal.id]
 
             return (
               <div
@@ -220,6 +234,22 @@ export default function SavingsGoals({ onUpdate }) {
                   </div>
                 </div>
 
+                {projection && remaining > 0 && (
+                  <div className="flex items-center gap-2 text-sm text-gray-600 mb-4">
+                    <TrendingUp size={16} />
+                    {projection.probability !== null ? (
+                      <span className={projection.probability >= 0.7 ? 'text-green-700' : projection.probability >= 0.4 ? 'text-yellow-700' : 'text-red-700'}>
+                        {Math.round(projection.probability * 100)}% chance by deadline
+                      </span>
+                    ) : null}
+                    <span>
+                      {projection.expected_completion
+                        ? `Likely done by ${projection.expected_completion}`
+                        : 'Not reachable at your current savings rate'}
+                    </span>
+                  </div>
+                )}
+
                 {/* Update Progress */}
                 <div className="flex gap-2">
                   <input